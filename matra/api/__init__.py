@@ -26,6 +26,22 @@ API_SERVICE_OPTS = [
                default='0.0.0.0',
                help='The listen IP for matra API server',
                ),
+    cfg.IntOpt('late_arrival_window',
+               default=600,
+               help='Seconds after which datapoints are no longer expected '
+                    'to arrive; metric data queries ending before then get '
+                    'ETags',
+               ),
+    cfg.StrOpt('immutable_cache_control',
+               default='private, max-age=3600',
+               help='Cache-Control sent with metric data for ranges past '
+                    'the late arrival window',
+               ),
+    cfg.IntOpt('query_flight_log_interval',
+               default=300,
+               help='Seconds between logs of the metric data queries '
+                    'coalesced by each worker, 0 disables them',
+               ),
 ]
 
 CONF = cfg.CONF
@@ -0,0 +1,175 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+gzip/deflate content coding of responses and request bodies
+"""
+
+import zlib
+
+from oslo.config import cfg
+import webob.dec
+import webob.exc
+
+from matra.common import wsgi
+
+from matra.openstack.common import log as logging
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_OPTS = [
+    cfg.IntOpt('level',
+               default=5,
+               help='zlib compression level of responses, clamped to 1-9',
+               ),
+    cfg.IntOpt('min_size',
+               default=1024,
+               help='Responses of known length below this many bytes are '
+                    'sent uncompressed',
+               ),
+    cfg.IntOpt('max_request_size',
+               default=64 * 1024 * 1024,
+               help='Largest decompressed request body accepted, in bytes',
+               ),
+]
+
+CONF = cfg.CONF
+opt_group = cfg.OptGroup(name='compression',
+                         title='Options for HTTP compression')
+CONF.register_group(opt_group)
+CONF.register_opts(COMPRESSION_OPTS, opt_group)
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/xml', 'text/')
+
+# zlib window bits producing each content coding
+_ENCODE_WBITS = {'gzip': 16 + zlib.MAX_WBITS,
+                 'deflate': zlib.MAX_WBITS}
+
+
+def _compress_iter(app_iter, compressor):
+    """Compress each chunk of `app_iter` as the server asks for it."""
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class CompressionMiddleware(wsgi.Middleware):
+    """
+    Compress responses for clients accepting gzip or deflate, and decode
+    gzip or deflate request bodies before they reach the application.
+
+    A strong ETag gets the coding appended, since the compressed bytes
+    are a different representation of the resource.
+    """
+
+    def __init__(self, application, conf=None, **local_conf):
+        super(CompressionMiddleware, self).__init__(application)
+        opts = (conf or CONF).compression
+        self.level = min(max(opts.level, 1), 9)
+        self.min_size = opts.min_size
+        self.max_request_size = opts.max_request_size
+
+    def _decode_request(self, req, coding):
+        """Replace a compressed request body by its decoded content."""
+        if coding not in ('gzip', 'deflate'):
+            return webob.exc.HTTPUnsupportedMediaType(
+                _('Unsupported Content-Encoding %s') % coding)
+        # Accept gzip and zlib headers alike, or raw deflate data
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        body = req.body
+        try:
+            try:
+                data = decompressor.decompress(body, self.max_request_size)
+            except zlib.error:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = decompressor.decompress(body, self.max_request_size)
+        except zlib.error as err:
+            return webob.exc.HTTPBadRequest(str(err))
+        if decompressor.unconsumed_tail:
+            return webob.exc.HTTPRequestEntityTooLarge()
+        del req.headers['Content-Encoding']
+        req.body = data
+        return None
+
+    @staticmethod
+    def _compressible(response):
+        """Whether the response may be compressed for some clients."""
+        if response.content_encoding or not response.content_type:
+            return False
+        return response.content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def _should_compress(self, req, response):
+        if req.method == 'HEAD' or response.status_int in (204, 304):
+            return False
+        length = response.content_length
+        return length is None or length >= self.min_size
+
+    @staticmethod
+    def _negotiate(req):
+        """
+        Return the coding the client prefers among gzip and deflate, or
+        None. Clients sending no Accept-Encoding get the identity coding.
+        """
+        if 'Accept-Encoding' not in req.headers:
+            return None
+        best, best_quality = None, 0
+        for coding in ('gzip', 'deflate'):
+            quality = req.accept_encoding.quality(coding) or 0
+            if quality > best_quality:
+                best, best_quality = coding, quality
+        return best
+
+    @staticmethod
+    def _add_vary(response):
+        vary = response.headers.get('Vary')
+        response.headers['Vary'] = (vary + ', Accept-Encoding' if vary
+                                    else 'Accept-Encoding')
+
+    def _encode_response(self, coding, response):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      _ENCODE_WBITS[coding])
+        response.app_iter = _compress_iter(response.app_iter, compressor)
+        response.content_length = None
+        response.content_encoding = coding
+        etag = response.headers.get('ETag')
+        if etag and etag.endswith('"') and not etag.startswith('W/'):
+            response.headers['ETag'] = '%s-%s"' % (etag[:-1], coding)
+        return response
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        coding = req.headers.get('Content-Encoding')
+        if coding and coding != 'identity':
+            error = self._decode_request(req, coding.strip().lower())
+            if error is not None:
+                return error
+
+        response = req.get_response(self.application)
+        if not self._compressible(response):
+            return response
+        # The coding depends on Accept-Encoding, even when left identity
+        self._add_vary(response)
+        if not self._should_compress(req, response):
+            return response
+        coding = self._negotiate(req)
+        if coding is None:
+            return response
+        return self._encode_response(coding, response)
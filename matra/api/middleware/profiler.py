@@ -0,0 +1,261 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Profiling of live API workers.
+
+A fraction of requests, or the next N requests after SIGUSR2 or a POST to
+the admin path, run under cProfile or a statistical stack sampler. Results
+are aggregated per route and written per worker to `output_dir`, as pstats
+files for cProfile and as collapsed stacks (the input of flamegraph.pl) for
+the sampler.
+
+Greenthreads switching while a request is profiled get profiled along with
+it, so only one request per worker is profiled at a time.
+"""
+
+import collections
+import cProfile
+import json
+import os
+import pstats
+import random
+import signal
+
+from oslo.config import cfg
+import webob
+import webob.dec
+import webob.exc
+
+from matra.common import wsgi
+
+from matra.openstack.common import fileutils
+from matra.openstack.common import log as logging
+
+logger = logging.getLogger(__name__)
+
+PROFILER_OPTS = [
+    cfg.StrOpt('mode',
+               default='cprofile',
+               help='Profiler to use, cprofile or sampler',
+               ),
+    cfg.FloatOpt('sample_rate',
+                 default=0.0,
+                 help='Fraction of requests profiled, 0 profiles only on '
+                      'demand',
+                 ),
+    cfg.IntOpt('on_demand_requests',
+               default=100,
+               help='Requests profiled after a SIGUSR2 or an admin call',
+               ),
+    cfg.IntOpt('max_on_demand_requests',
+               default=1000,
+               help='Most requests left to profile on demand at any time',
+               ),
+    cfg.FloatOpt('sampler_interval',
+                 default=0.005,
+                 help='Seconds of CPU time between stack samples',
+                 ),
+    cfg.IntOpt('dump_every',
+               default=100,
+               help='Profiled requests between writes of the profiles, 0 '
+                    'writes them only when asked on the admin path',
+               ),
+    cfg.StrOpt('output_dir',
+               default='/tmp/matra-profiles',
+               help='Directory the per-worker profiles are written to',
+               ),
+    cfg.StrOpt('admin_path',
+               default='/admin/profile',
+               help='Path to query and trigger the profiler',
+               ),
+    cfg.ListOpt('admin_hosts',
+                default=['127.0.0.1', '::1'],
+                help='Client addresses allowed on the admin path',
+                ),
+]
+
+CONF = cfg.CONF
+opt_group = cfg.OptGroup(name='profiler',
+                         title='Options for the API profiler')
+CONF.register_group(opt_group)
+CONF.register_opts(PROFILER_OPTS, opt_group)
+
+
+class StackSampler(object):
+    """Count the Python stacks seen on every SIGPROF tick."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[';'.join(stack)] += 1
+
+    def start(self, samples):
+        self.samples = samples
+        signal.signal(signal.SIGPROF, self._sample)
+        # Otherwise socket and storage I/O of the request fail with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.samples = None
+
+
+class ProfilerMiddleware(wsgi.Middleware):
+    """
+    Profile sampled or requested requests, aggregating the results per
+    route. When neither applies, a request costs one random() call.
+    """
+
+    def __init__(self, application, conf=None, **local_conf):
+        super(ProfilerMiddleware, self).__init__(application)
+        opts = (conf or CONF).profiler
+        if opts.mode not in ('cprofile', 'sampler'):
+            raise ValueError(_('Unknown profiler mode %s') % opts.mode)
+        self.mode = opts.mode
+        self.sample_rate = opts.sample_rate
+        self.on_demand_requests = opts.on_demand_requests
+        self.max_on_demand = opts.max_on_demand_requests
+        self.dump_every = opts.dump_every
+        self.output_dir = opts.output_dir
+        self.admin_path = opts.admin_path
+        self.admin_hosts = frozenset(opts.admin_hosts)
+        self.sampler = StackSampler(opts.sampler_interval)
+
+        self.on_demand = 0
+        self.active = False
+        self.profiled = 0
+        self.routes = {}
+        signal.signal(signal.SIGUSR2, self._on_signal)
+
+    def _add_on_demand(self, requests):
+        self.on_demand = min(self.on_demand + requests, self.max_on_demand)
+
+    def _on_signal(self, signum, frame):
+        self._add_on_demand(self.on_demand_requests)
+
+    def _should_profile(self):
+        if self.active:
+            return False
+        if self.on_demand > 0:
+            self.on_demand -= 1
+            return True
+        return random.random() < self.sample_rate
+
+    @staticmethod
+    def _route(req):
+        args = req.environ.get('wsgiorg.routing_args')
+        match = args and args[1]
+        return match and match.get('action') or 'unmatched'
+
+    def _profile(self, req):
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                response = req.get_response(self.application)
+            finally:
+                profile.disable()
+            route = self._route(req)
+            stats = self.routes.get(route)
+            if stats is None:
+                self.routes[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        else:
+            samples = collections.Counter()
+            self.sampler.start(samples)
+            try:
+                response = req.get_response(self.application)
+            finally:
+                self.sampler.stop()
+            route = self._route(req)
+            self.routes.setdefault(route, collections.Counter()).update(
+                samples)
+
+        self.profiled += 1
+        if self.dump_every > 0 and self.profiled % self.dump_every == 0:
+            self.dump()
+        return response
+
+    def dump(self):
+        """Write the aggregated profiles of this worker, return the paths."""
+        fileutils.ensure_tree(self.output_dir)
+        pid = os.getpid()
+        paths = []
+        for route, profile in self.routes.iteritems():
+            if self.mode == 'cprofile':
+                path = os.path.join(self.output_dir,
+                                    '%s.%d.pstats' % (route, pid))
+                profile.dump_stats(path)
+            else:
+                path = os.path.join(self.output_dir,
+                                    '%s.%d.collapsed' % (route, pid))
+                with open(path, 'w') as f:
+                    for stack, count in profile.iteritems():
+                        f.write('%s %d\n' % (stack, count))
+            paths.append(path)
+        logger.info(_('Wrote %(count)d profiles to %(dir)s'),
+                    {'count': len(paths), 'dir': self.output_dir})
+        return paths
+
+    def _admin(self, req):
+        """
+        GET reports the profiler state. POST profiles the next `requests`
+        requests (on_demand_requests by default), and writes the profiles
+        out when `dump` is set. Only clients in admin_hosts are answered.
+        """
+        if req.remote_addr not in self.admin_hosts:
+            return webob.exc.HTTPForbidden()
+        result = {'pid': os.getpid(),
+                  'mode': self.mode,
+                  'profiled': self.profiled}
+        if req.method == 'POST':
+            try:
+                requests = int(req.params.get('requests',
+                                              self.on_demand_requests))
+            except ValueError:
+                return webob.exc.HTTPBadRequest()
+            if requests < 0:
+                return webob.exc.HTTPBadRequest()
+            self._add_on_demand(requests)
+            if req.params.get('dump'):
+                result['files'] = self.dump()
+        result['on_demand'] = self.on_demand
+        result['routes'] = sorted(self.routes)
+        return webob.Response(content_type='application/json',
+                              body=json.dumps(result))
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        if req.path_info == self.admin_path:
+            return self._admin(req)
+        if not self._should_profile():
+            return req.get_response(self.application)
+        self.active = True
+        try:
+            return self._profile(req)
+        finally:
+            self.active = False
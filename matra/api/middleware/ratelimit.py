@@ -0,0 +1,195 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per-tenant token bucket rate limiting.
+
+Buckets live in a fixed-size table in shared memory which is allocated when
+the middleware is built, before wsgi.Server forks its workers, so limits
+hold per host rather than per worker process. Buckets are updated without
+locks; concurrent workers can occasionally lose an update, which only makes
+the limit slightly more lenient.
+"""
+
+import ctypes
+import math
+from multiprocessing import sharedctypes
+import time
+
+from oslo.config import cfg
+import webob.dec
+import webob.exc
+
+from matra.common import wsgi
+
+from matra.openstack.common import log as logging
+
+logger = logging.getLogger(__name__)
+
+RATELIMIT_OPTS = [
+    cfg.FloatOpt('requests_per_second',
+                 default=100.0,
+                 help='Sustained requests per second allowed per tenant '
+                      '(<= 0 means unlimited)',
+                 ),
+    cfg.FloatOpt('requests_burst',
+                 default=200.0,
+                 help='Requests a tenant may burst above the sustained rate',
+                 ),
+    cfg.FloatOpt('datapoints_per_second',
+                 default=50000.0,
+                 help='Sustained datapoints per second allowed per tenant '
+                      '(<= 0 means unlimited)',
+                 ),
+    cfg.FloatOpt('datapoints_burst',
+                 default=100000.0,
+                 help='Datapoints a tenant may burst above the sustained '
+                      'rate',
+                 ),
+    cfg.IntOpt('table_size',
+               default=4096,
+               help='Number of tenant buckets kept in shared memory',
+               ),
+]
+
+CONF = cfg.CONF
+opt_group = cfg.OptGroup(name='ratelimit',
+                         title='Options for per-tenant rate limiting')
+CONF.register_group(opt_group)
+CONF.register_opts(RATELIMIT_OPTS, opt_group)
+
+# Handlers that ingest datapoints report how many they accepted under this
+# environ key, so the datapoint bucket can be charged once they are known.
+DATAPOINTS_ENV_KEY = 'matra.datapoints'
+
+
+class _Bucket(ctypes.Structure):
+    _fields_ = [('tag', ctypes.c_longlong),
+                ('updated', ctypes.c_double),
+                ('requests', ctypes.c_double),
+                ('datapoints', ctypes.c_double)]
+
+
+class BucketTable(object):
+    """
+    Open-addressed table of token buckets in shared memory.
+
+    A tenant hashes to a short probe sequence; when all slots in it belong
+    to other tenants, the least recently updated one is recycled. Lookups
+    are therefore O(1) and the table never grows.
+    """
+
+    PROBES = 4
+
+    def __init__(self, size):
+        self.size = size
+        self._slots = sharedctypes.RawArray(_Bucket, size)
+
+    def get(self, tenant_id, now, requests, datapoints):
+        """
+        Return the bucket of `tenant_id`, claiming one filled with
+        `requests` and `datapoints` tokens if the tenant has none.
+        """
+        # 0 marks a free slot
+        tag = hash(tenant_id) or 1
+        base = tag % self.size
+        victim = None
+        for i in xrange(self.PROBES):
+            bucket = self._slots[(base + i) % self.size]
+            if bucket.tag == tag:
+                return bucket
+            if bucket.tag == 0:
+                victim = bucket
+                break
+            if victim is None or bucket.updated < victim.updated:
+                victim = bucket
+        victim.tag = tag
+        victim.updated = now
+        victim.requests = requests
+        victim.datapoints = datapoints
+        return victim
+
+
+class RateLimitMiddleware(wsgi.Middleware):
+    """
+    Enforce per-tenant requests/sec and datapoints/sec token buckets,
+    answering 429 with Retry-After once a tenant runs dry. The tenant is
+    the first segment of the request path.
+
+    Datapoints are only known once the request has been handled, so they
+    are charged afterwards and a tenant may run into debt for one request;
+    it is then throttled until the bucket refills.
+    """
+
+    def __init__(self, application, conf=None, **local_conf):
+        super(RateLimitMiddleware, self).__init__(application)
+        opts = (conf or CONF).ratelimit
+        self.requests_rate = opts.requests_per_second
+        self.requests_burst = opts.requests_burst
+        self.datapoints_rate = opts.datapoints_per_second
+        self.datapoints_burst = opts.datapoints_burst
+        self.table = BucketTable(opts.table_size)
+
+    @staticmethod
+    def tenant_from_path(path):
+        parts = path.split('/', 2)
+        if len(parts) < 2 or not parts[1]:
+            return None
+        return parts[1]
+
+    def _refill(self, bucket, now):
+        elapsed = now - bucket.updated
+        if elapsed <= 0:
+            return
+        bucket.updated = now
+        bucket.requests = min(self.requests_burst,
+                              bucket.requests + elapsed * self.requests_rate)
+        bucket.datapoints = min(self.datapoints_burst,
+                                bucket.datapoints +
+                                elapsed * self.datapoints_rate)
+
+    def _retry_after(self, bucket):
+        """Seconds until both buckets hold tokens again."""
+        wait = 0.0
+        if self.requests_rate > 0 and bucket.requests < 1:
+            wait = (1 - bucket.requests) / self.requests_rate
+        if self.datapoints_rate > 0 and bucket.datapoints <= 0:
+            wait = max(wait, -bucket.datapoints / self.datapoints_rate)
+        return wait
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        tenant_id = self.tenant_from_path(req.path_info)
+        if tenant_id is None:
+            return req.get_response(self.application)
+
+        now = time.time()
+        bucket = self.table.get(tenant_id, now, self.requests_burst,
+                                self.datapoints_burst)
+        self._refill(bucket, now)
+
+        wait = self._retry_after(bucket)
+        if wait > 0:
+            logger.debug('Rate limiting tenant %s for %.2fs', tenant_id, wait)
+            return webob.exc.HTTPTooManyRequests(
+                headers={'Retry-After': str(int(math.ceil(wait)))})
+
+        if self.requests_rate > 0:
+            bucket.requests -= 1
+        response = req.get_response(self.application)
+        datapoints = req.environ.get(DATAPOINTS_ENV_KEY)
+        if datapoints and self.datapoints_rate > 0:
+            bucket.datapoints -= datapoints
+        return response
@@ -18,10 +18,21 @@ Stack endpoint for Matra v1 ReST API.
 """
 
 import itertools
+import numbers
+import os
+import time
+
+from oslo.config import cfg
 from webob import exc
 
-from matra.api.openstack.v1 import util
+from matra.api.middleware import ratelimit
+from matra.api.v1 import util
+from matra.common import aggregate
+from matra.common import singleflight
 from matra.common import wsgi
+from matra.ingest import rpcapi as ingest_rpcapi
+from matra.openstack.common import context
+from matra.openstack.common import loopingcall
 
 from matra.openstack.common import log as logging
 
@@ -36,16 +47,125 @@ class MetricsController(object):
 
     def __init__(self, options):
         self.options = options
+        # Identical concurrent queries share one storage read
+        self.query_flights = singleflight.SingleFlight()
+        self._flight_logger_pid = None
+        self.ingest_rpcapi = ingest_rpcapi.IngestAPI()
+
+    def _start_flight_logger(self):
+        # NOTE(lakshmi): started lazily so each forked worker runs its own
+        self._flight_logger_pid = os.getpid()
+        interval = cfg.CONF.api.query_flight_log_interval
+        if interval > 0:
+            flight_logger = loopingcall.FixedIntervalLoopingCall(
+                self._log_flights)
+            flight_logger.start(interval, interval)
+
+    def _log_flights(self):
+        logger.info(_("Query coalescing for worker %(pid)s: %(stats)s"),
+                    {'pid': os.getpid(),
+                     'stats': self.query_flights.stats()})
 
     def default(self, req, **args):
         raise exc.HTTPNotFound()
 
+    @staticmethod
+    def _validate_batch(tenant_id, body):
+        """
+        Turn a {"metrics": [{"name", "timestamp", "value"}]} body into a
+        list of datapoints, or raise HTTPBadRequest.
+        """
+        try:
+            metrics = body['metrics']
+            datapoints = [{'tenant_id': tenant_id,
+                           'metric_name': metric['name'],
+                           'timestamp': metric['timestamp'],
+                           'value': metric['value']}
+                          for metric in metrics]
+        except (KeyError, TypeError):
+            raise exc.HTTPBadRequest()
+        for point in datapoints:
+            if not (isinstance(point['metric_name'], basestring) and
+                    point['metric_name'] and
+                    isinstance(point['timestamp'], numbers.Real) and
+                    isinstance(point['value'], numbers.Real)):
+                raise exc.HTTPBadRequest()
+        return datapoints
+
     @util.tenant_local
     @util.attach_storage_engine
-    def ingest_metrics(self, req):
+    def ingest_metrics(self, req, body=None):
         """
-        Ingest new metrics
+        Ingest new metrics, either directly or by casting the batch to the
+        ingest workers when [ingest] use_rpc is set
         """
+        tenant_id = req.context.tenant_id
+        datapoints = self._validate_batch(tenant_id, body)
+        req.environ[ratelimit.DATAPOINTS_ENV_KEY] = len(datapoints)
+
+        if cfg.CONF.ingest.use_rpc:
+            ctxt = context.RequestContext(tenant=tenant_id)
+            self.ingest_rpcapi.ingest_metrics(ctxt, datapoints)
+            return {'accepted': len(datapoints), 'queued': True}
+
+        conn = req.context.storage_engine.get_connection(cfg.CONF)
+        conn.ingest_metrics(datapoints)
+        return {'accepted': len(datapoints), 'queued': False}
+
+    @util.tenant_local
+    @util.attach_storage_engine
+    def get_data_for_metric(self, req, metric_name):
+        """
+        Return the datapoints of a metric between the `from` and `to`
+        timestamps, aggregated into buckets of `resolution` seconds
+        """
+        try:
+            start = float(req.params['from'])
+            end = float(req.params['to'])
+            resolution = float(req.params.get('resolution', 300))
+        except (KeyError, ValueError):
+            raise exc.HTTPBadRequest()
+        if resolution <= 0 or end < start:
+            raise exc.HTTPBadRequest()
+
+        tenant_id = req.context.tenant_id
+        key = (tenant_id, metric_name, start, end, resolution)
+        conn = req.context.storage_engine.get_connection(cfg.CONF)
+
+        # Ranges past the late arrival window only change on backfill, which
+        # moves the series' write watermark, so one watermark lookup is
+        # enough to validate a cached copy.
+        api_conf = cfg.CONF.api
+        if end < time.time() - api_conf.late_arrival_window:
+            watermark = conn.get_metric_watermark(tenant_id, metric_name)
+            etag = util.make_etag(watermark, *key)
+            if util.etag_matches(req, etag):
+                raise exc.HTTPNotModified(headers={
+                    'ETag': etag,
+                    'Cache-Control': api_conf.immutable_cache_control})
+            req.environ[util.CACHE_VALIDATORS_KEY] = (
+                etag, api_conf.immutable_cache_control)
+
+        if self._flight_logger_pid != os.getpid():
+            self._start_flight_logger()
+        return self.query_flights.do(key, self._query_metric_data,
+                                     conn, tenant_id, metric_name,
+                                     start, end, resolution)
+
+    def _query_metric_data(self, conn, tenant_id, metric_name,
+                           start, end, resolution):
+        try:
+            buckets = aggregate.query(conn, tenant_id, metric_name,
+                                      start, end, resolution)
+        except aggregate.AggregateTimeout:
+            raise exc.HTTPServiceUnavailable()
+        return {'metric_name': metric_name,
+                'data': [{'timestamp': ts,
+                          'count': int(count),
+                          'average': total / count,
+                          'min': low,
+                          'max': high}
+                         for ts, count, total, low, high in buckets]}
 
 
 class QuerySerializer(wsgi.JSONResponseSerializer):
@@ -64,6 +184,20 @@ class QuerySerializer(wsgi.JSONResponseSerializer):
         response.body = self.to_json(result)
         return response
 
+    def ingest_metrics(self, response, result):
+        self.default(response, result)
+        response.status = 202 if result['queued'] else 200
+        return response
+
+    def get_data_for_metric(self, response, result):
+        self.default(response, result)
+        validators = response.request.environ.get(util.CACHE_VALIDATORS_KEY)
+        if validators:
+            etag, cache_control = validators
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = cache_control
+        return response
+
 
 def create_resource(options):
     """
@@ -72,4 +206,4 @@ def create_resource(options):
     # TODO(zaneb) handle XML based on Content-type/Accepts
     deserializer = wsgi.JSONRequestDeserializer()
     serializer = QuerySerializer()
-    return wsgi.Resource(QueryController(options), deserializer, serializer)
+    return wsgi.Resource(MetricsController(options), deserializer, serializer)
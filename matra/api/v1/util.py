@@ -14,8 +14,19 @@
 #    under the License.
 
 from functools import wraps
+import hashlib
+
+from oslo.config import cfg
+
 from matra import storage
 
+# Environ key under which a controller leaves the (etag, cache_control) pair
+# for its serializer
+CACHE_VALIDATORS_KEY = 'matra.cache_validators'
+
+# Content codings appended to an ETag by the compression middleware
+_ETAG_CODING_SUFFIXES = ('-gzip"', '-deflate"')
+
 def tenant_local(handler):
     '''
     Decorator for a handler method that sets the correct tenant_id in the
@@ -34,8 +45,39 @@ def attach_storage_engine(handler):
     to execute the request
     '''
     @wraps(handler)
-    def attach_engine(controller, req, tenant_id, **kwargs):
-        req.context.storage_engine = storage.get_engine(conf)
+    def attach_engine(controller, req, **kwargs):
+        req.context.storage_engine = storage.get_engine(cfg.CONF)
         return handler(controller, req, **kwargs)
 
     return attach_engine
+
+
+def make_etag(*parts):
+    '''
+    Return a strong, quoted ETag derived from the given values
+    '''
+    return '"%s"' % hashlib.sha1(repr(parts)).hexdigest()
+
+
+def etag_matches(req, etag):
+    '''
+    Whether `etag` is listed in the If-None-Match header of the request.
+    Weak comparison is used, as RFC 7232 asks for If-None-Match, and the
+    content coding suffix of compressed responses is ignored.
+    '''
+    header = req.headers.get('If-None-Match')
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        for suffix in _ETAG_CODING_SUFFIXES:
+            if candidate.endswith(suffix):
+                candidate = candidate[:-len(suffix)] + '"'
+                break
+        if candidate == etag:
+            return True
+    return False
@@ -0,0 +1,210 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Bucket aggregation of metric datapoints
+
+Small queries are read and aggregated inline in the API worker. Queries
+above `aggregate_offload_threshold` datapoints are handed to a pool of
+worker processes, which read and decode the datapoints from storage
+themselves, so neither the decoding nor the CPU-bound loop hold the GIL of
+the API worker and starve its other greenthreads. Buckets travel back as
+raw doubles in a tmpfs-backed segment instead of a pickled list.
+"""
+
+import array
+import itertools
+import multiprocessing
+import os
+import tempfile
+
+from eventlet import tpool
+from oslo.config import cfg
+
+from matra import storage
+from matra.openstack.common import log as logging
+
+
+aggregate_opts = [
+    cfg.IntOpt('aggregate_offload_threshold', default=50000,
+               help=_('Number of datapoints above which a query is '
+                      'aggregated in a worker process. 0 disables '
+                      'offloading.')),
+    cfg.IntOpt('aggregate_workers', default=2,
+               help=_('Number of aggregation worker processes started by '
+                      'each API worker')),
+    cfg.StrOpt('aggregate_shm_dir', default='/dev/shm',
+               help=_('tmpfs directory used by the aggregation workers '
+                      'to hand back buckets')),
+    cfg.FloatOpt('aggregate_timeout', default=60.0,
+                 help=_('Seconds to wait for an aggregation worker before '
+                        'failing the query')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(aggregate_opts)
+
+LOG = logging.getLogger(__name__)
+
+# Each bucket is stored as (start, count, sum, min, max)
+BUCKET_FIELDS = 5
+
+_pool = None
+_pool_pid = None
+_storage_conn = None
+
+
+class AggregateTimeout(Exception):
+    """An aggregation worker did not answer within aggregate_timeout."""
+
+
+def _bucketize(timestamps, values, start, resolution):
+    """Fold time-ordered datapoints into a flat array of buckets."""
+    buckets = array.array('d')
+    slot = None
+    pos = 0
+    for ts, value in itertools.izip(timestamps, values):
+        current = int((ts - start) // resolution)
+        if current != slot:
+            slot = current
+            pos = len(buckets)
+            buckets.extend((start + slot * resolution, 1, value,
+                            value, value))
+            continue
+        buckets[pos + 1] += 1
+        buckets[pos + 2] += value
+        if value < buckets[pos + 3]:
+            buckets[pos + 3] = value
+        if value > buckets[pos + 4]:
+            buckets[pos + 4] = value
+    return buckets
+
+
+def _to_arrays(points):
+    """Split (timestamp, value) pairs into two arrays of doubles."""
+    timestamps = array.array('d')
+    values = array.array('d')
+    for ts, value in points:
+        timestamps.append(ts)
+        values.append(value)
+    return timestamps, values
+
+
+def _new_segment():
+    """Create an empty shared segment, return its path."""
+    fd, path = tempfile.mkstemp(prefix='matra-agg-',
+                                dir=CONF.aggregate_shm_dir)
+    os.close(fd)
+    return path
+
+
+def _read_segment(path):
+    """Read back and remove a shared segment written by a worker."""
+    data = array.array('d')
+    try:
+        with open(path, 'rb') as f:
+            count = os.fstat(f.fileno()).st_size // data.itemsize
+            data.fromfile(f, count)
+    finally:
+        os.unlink(path)
+    return data
+
+
+def _aggregate_query(out_path, tenant_id, metric_name, start, end,
+                     resolution):
+    """Worker process entry point."""
+    global _storage_conn
+    if _storage_conn is None:
+        _storage_conn = storage.get_connection(CONF)
+    points = _storage_conn.get_metric_data(tenant_id, metric_name, start, end)
+    timestamps, values = _to_arrays(points)
+    buckets = _bucketize(timestamps, values, start, resolution)
+    # The caller removes out_path when it stops waiting, don't recreate it
+    with open(out_path, 'r+b') as f:
+        buckets.tofile(f)
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    # NOTE(lakshmi): a pool inherited across wsgi.Server's fork() has dead
+    # result handler threads, so every API worker builds its own.
+    if _pool is None or _pool_pid != os.getpid():
+        LOG.debug(_('Starting %d aggregation workers'),
+                  CONF.aggregate_workers)
+        _pool = multiprocessing.Pool(processes=CONF.aggregate_workers)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def _offload(tenant_id, metric_name, start, end, resolution):
+    out_path = _new_segment()
+    try:
+        result = _get_pool().apply_async(
+            _aggregate_query,
+            (out_path, tenant_id, metric_name, start, end, resolution))
+        # Waiting on the result blocks a native thread, keep the hub free
+        tpool.execute(result.get, CONF.aggregate_timeout)
+    except multiprocessing.TimeoutError:
+        os.unlink(out_path)
+        raise AggregateTimeout()
+    except Exception:
+        os.unlink(out_path)
+        raise
+    return _read_segment(out_path)
+
+
+def _to_tuples(buckets):
+    return [tuple(buckets[i:i + BUCKET_FIELDS])
+            for i in xrange(0, len(buckets), BUCKET_FIELDS)]
+
+
+def aggregate(points, start, resolution):
+    """
+    Aggregate datapoints into buckets of `resolution` seconds.
+
+    :param points: iterable of (timestamp, value) pairs in time order
+    :param start: timestamp the first bucket is aligned to
+    :param resolution: bucket width in seconds
+    :returns: list of (bucket_start, count, sum, min, max) tuples
+    """
+    timestamps, values = _to_arrays(points)
+    return _to_tuples(_bucketize(timestamps, values, start, resolution))
+
+
+def query(conn, tenant_id, metric_name, start, end, resolution):
+    """
+    Read the datapoints of a metric between `start` and `end` from storage
+    and aggregate them into buckets of `resolution` seconds.
+
+    Storage first counts the datapoints, up to one past
+    `aggregate_offload_threshold`. Series up to the threshold are read and
+    aggregated here; larger ones are read and aggregated by a worker
+    process, so none of their datapoints are decoded in the API worker.
+
+    :param conn: storage connection the datapoints are counted with, and
+                 read with when aggregated here
+    :returns: list of (bucket_start, count, sum, min, max) tuples
+    :raises: AggregateTimeout if the worker is slower than
+             `aggregate_timeout`
+    """
+    threshold = CONF.aggregate_offload_threshold
+    if threshold > 0:
+        count = conn.count_metric_data(tenant_id, metric_name, start, end,
+                                       limit=threshold + 1)
+        if count > threshold:
+            return _to_tuples(_offload(tenant_id, metric_name, start, end,
+                                       resolution))
+    points = conn.get_metric_data(tenant_id, metric_name, start, end)
+    return aggregate(points, start, resolution)
@@ -0,0 +1,85 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Fixed-size log-linear latency histograms
+"""
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style histogram of latencies in microseconds.
+
+    Every power-of-two range is split into 2 ** (SUB_BUCKET_BITS - 1) linear
+    buckets, so a recorded value is off by at most 1 / 2 ** (SUB_BUCKET_BITS
+    - 1) of itself, using a fixed list of counters. Recording is a handful
+    of integer operations and takes no lock; a histogram is meant to be
+    owned by a single worker process.
+    """
+
+    SUB_BUCKET_BITS = 5
+    # Values are clamped to about 19 hours
+    MAX_VALUE = 2 ** 36
+
+    def __init__(self):
+        self._half = 1 << (self.SUB_BUCKET_BITS - 1)
+        self.counts = [0] * (self._index(self.MAX_VALUE) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def _index(self, value):
+        exponent = value.bit_length() - self.SUB_BUCKET_BITS
+        if exponent <= 0:
+            return value
+        return exponent * self._half + (value >> exponent)
+
+    def _value_at(self, index):
+        """Lowest value that falls into bucket `index`."""
+        if index < 2 * self._half:
+            return index
+        exponent = index // self._half - 1
+        return (index - exponent * self._half) << exponent
+
+    def record(self, seconds):
+        value = min(int(seconds * 1000000), self.MAX_VALUE)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """Return the `pct` percentile in microseconds."""
+        if not self.count:
+            return 0
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return self._value_at(index)
+        return self.max
+
+    def summary(self):
+        """Return count, mean and percentiles in milliseconds."""
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.sum / 1000.0 / self.count,
+                'p50': self.percentile(50) / 1000.0,
+                'p90': self.percentile(90) / 1000.0,
+                'p99': self.percentile(99) / 1000.0,
+                'max': self.max / 1000.0}
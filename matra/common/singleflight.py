@@ -0,0 +1,90 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Coalescing of identical concurrent calls
+"""
+
+import sys
+
+from eventlet import event
+
+from matra.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# Result handed to followers when the leader was killed before answering
+_ABORTED = object()
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = event.Event()
+        self.joined = 0
+
+
+class SingleFlight(object):
+    """
+    Run at most one call per key at a time. Greenthreads asking for a key
+    that is already in flight wait for that call and share its result (or
+    its exception) instead of making their own.
+
+    Shared results are handed to every caller as the same object, so
+    callers must treat them as read-only. When the leader is killed or
+    times out, its followers start over, one of them taking the lead.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.flights = 0
+        self.absorbed = 0
+        self.max_absorbed = 0
+
+    def do(self, key, func, *args, **kwargs):
+        flight = self._flights.get(key)
+        while flight is not None:
+            flight.joined += 1
+            self.absorbed += 1
+            result = flight.event.wait()
+            if result is not _ABORTED:
+                return result
+            flight = self._flights.get(key)
+
+        flight = self._flights[key] = _Flight()
+        self.flights += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            flight.event.send_exception(*sys.exc_info())
+            raise
+        except BaseException:
+            # Killed or timed out: that's the leader's own fate, not an
+            # answer for the followers
+            flight.event.send(_ABORTED)
+            raise
+        else:
+            flight.event.send(result)
+        finally:
+            del self._flights[key]
+        if flight.joined:
+            LOG.debug('Flight %r absorbed %d requests', key, flight.joined)
+            self.max_absorbed = max(self.max_absorbed, flight.joined)
+        return result
+
+    def stats(self):
+        return {'flights': self.flights,
+                'in_flight': len(self._flights),
+                'absorbed': self.absorbed,
+                'max_absorbed': self.max_absorbed}
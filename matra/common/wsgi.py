@@ -23,15 +23,19 @@ Utility methods for working with WSGI servers
 
 import datetime
 import errno
+import functools
+import itertools
 import json
 import logging
 import os
+import re
 import signal
 import sys
 import time
 
 import eventlet
 import eventlet.greenio
+import eventlet.semaphore
 from eventlet.green import socket
 from eventlet.green import ssl
 import eventlet.wsgi
@@ -40,16 +44,22 @@ from oslo.config import cfg
 from paste import deploy
 import routes
 import routes.middleware
+import routes.util
 import webob.dec
 import webob.exc
 
 from matra.common import exception
+from matra.common import histogram
 from matra.openstack.common import gettextutils
 from matra.openstack.common import importutils
+from matra.openstack.common import loopingcall
 
 
 URL_LENGTH_LIMIT = 50000
 
+# A path segment that is entirely one variable, without a requirement regex
+_ROUTE_VAR = re.compile(r'^\{(\w+)\}$')
+
 bind_opts = [
     cfg.StrOpt('bind_host', default='0.0.0.0',
                help=_('Address to bind the server.  Useful when '
@@ -79,6 +89,52 @@ workers_opts = cfg.IntOpt('workers', default=0,
 
 cfg.CONF.register_opt(workers_opts)
 
+admission_opts = [
+    cfg.BoolOpt('admission_control', default=True,
+                help=_("Run ingest and query requests in separate "
+                       "concurrency pools, shedding load with a 503 "
+                       "when a pool's queue is full")),
+    cfg.IntOpt('ingest_pool_size', default=400,
+               help=_("Number of ingest requests processed concurrently")),
+    cfg.IntOpt('ingest_queue_length', default=400,
+               help=_("Number of ingest requests allowed to wait for a "
+                      "free slot before new ones are rejected")),
+    cfg.IntOpt('query_pool_size', default=100,
+               help=_("Number of query requests processed concurrently")),
+    cfg.IntOpt('query_queue_length', default=50,
+               help=_("Number of query requests allowed to wait for a "
+                      "free slot before new ones are rejected")),
+    cfg.FloatOpt('admission_queue_timeout', default=10.0,
+                 help=_("Seconds a request may wait for a free slot "
+                        "before it is rejected")),
+    cfg.IntOpt('admission_retry_after', default=1,
+               help=_("Retry-After seconds sent with rejected requests")),
+    cfg.StrOpt('admission_admin_path', default='/admin/admission',
+               help=_("Path answering with the admission pool counters "
+                      "of the worker serving the request")),
+]
+
+cfg.CONF.register_opts(admission_opts)
+
+latency_opts = [
+    cfg.StrOpt('latency_admin_path', default='/admin/latency',
+               help=_("Path answering with the per-route latency "
+                      "histograms of the worker serving the request")),
+    cfg.IntOpt('latency_dump_interval', default=300,
+               help=_("Seconds between periodic logs of the per-route "
+                      "latency histograms, 0 disables them")),
+]
+
+cfg.CONF.register_opts(latency_opts)
+
+json_opts = [
+    cfg.StrOpt('json_codec', default='auto',
+               help=_("JSON codec used for request and response bodies, "
+                      "'auto' picks the fastest one installed")),
+]
+
+cfg.CONF.register_opts(json_opts)
+
 
 class WritableLogger(object):
     """A thin wrapper that responds to `write` and logs."""
@@ -189,6 +245,9 @@ class Server(object):
             signal.signal(signal.SIGHUP, signal.SIG_IGN)
             self.running = False
 
+        conf.register_opts(admission_opts)
+        if conf.admission_control:
+            application = AdmissionControl(application, conf)
         self.application = application
         self.sock = get_socket(conf, default_port)
 
@@ -348,6 +407,290 @@ def debug_filter(app, conf, **local_conf):
     return Debug(app)
 
 
+class AdmissionPool(object):
+    """
+    A named concurrency limit with a bounded queue of waiting requests.
+
+    Counters are plain attributes; greenthreads only switch on the
+    semaphore, so updating them needs no locking.
+    """
+
+    def __init__(self, name, size, queue_length, queue_timeout=None):
+        self.name = name
+        self.size = size
+        self.queue_length = queue_length
+        self.queue_timeout = queue_timeout
+        self._semaphore = eventlet.semaphore.Semaphore(size)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def admit(self):
+        """
+        Wait for a free slot. Returns False if the request should be shed,
+        either because the queue is full or the wait timed out.
+        """
+        if self._semaphore.locked() and self.waiting >= self.queue_length:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        acquired = False
+        try:
+            with eventlet.Timeout(self.queue_timeout, False):
+                acquired = self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        if not acquired:
+            self.timed_out += 1
+            return False
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {'size': self.size,
+                'queue_length': self.queue_length,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out}
+
+
+class _AdmittedAppIter(object):
+    """Holds an admission slot until the server closes the response."""
+
+    def __init__(self, app_iter, pool):
+        self.app_iter = app_iter
+        self.pool = pool
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.pool is not None:
+                self.pool.release()
+                self.pool = None
+
+
+class AdmissionControl(Middleware):
+    """
+    Middleware that runs ingest and query requests in separate
+    AdmissionPools, so a storm of one kind cannot starve the other.
+
+    A request holds its slot until its response body is written out.
+    Server.start() puts it in front of the whole application, unless
+    `admission_control` is off. Each worker publishes its pool counters
+    as JSON on `admission_admin_path`.
+    """
+
+    INGEST = 'ingest'
+    QUERY = 'query'
+
+    def __init__(self, application, conf=None):
+        super(AdmissionControl, self).__init__(application)
+        conf = conf or cfg.CONF
+        conf.register_opts(admission_opts)
+        self.retry_after = str(conf.admission_retry_after)
+        self.admin_path = conf.admission_admin_path
+        self.pools = {
+            self.INGEST: AdmissionPool(self.INGEST,
+                                       conf.ingest_pool_size,
+                                       conf.ingest_queue_length,
+                                       conf.admission_queue_timeout),
+            self.QUERY: AdmissionPool(self.QUERY,
+                                      conf.query_pool_size,
+                                      conf.query_queue_length,
+                                      conf.admission_queue_timeout),
+        }
+
+    @classmethod
+    def classify(cls, environ):
+        """
+        Map a request to its pool without running the router: POSTs to
+        /{tenant_id}/metrics are ingest_metrics, everything else is a
+        list_metrics or get_data_for_metric query.
+        """
+        if environ['REQUEST_METHOD'] == 'POST' and \
+                environ.get('PATH_INFO', '').rstrip('/').endswith('/metrics'):
+            return cls.INGEST
+        return cls.QUERY
+
+    def stats(self):
+        return dict((name, pool.stats())
+                    for name, pool in self.pools.iteritems())
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.admin_path:
+            response = webob.Response(content_type='application/json',
+                                      body=json.dumps(self.stats()))
+            return response(environ, start_response)
+
+        pool = self.pools[self.classify(environ)]
+        if not pool.admit():
+            response = webob.exc.HTTPServiceUnavailable(
+                headers={'Retry-After': self.retry_after})
+            return response(environ, start_response)
+        try:
+            app_iter = self.application(environ, start_response)
+        except BaseException:
+            pool.release()
+            raise
+        return _AdmittedAppIter(app_iter, pool)
+
+
+# Environ key under which LatencyInstrumentation keeps the RequestTimer
+TIMER_ENV_KEY = 'matra.request_timer'
+
+
+class RequestTimer(object):
+    """Accumulates the time a single request spends in each phase."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.route = None
+        self.phases = {}
+        self._begun = {}
+
+    def add(self, phase, elapsed):
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+
+    def begin(self, phase):
+        self._begun[phase] = time.time()
+
+    def end(self, phase):
+        started = self._begun.pop(phase, None)
+        if started is not None:
+            self.add(phase, time.time() - started)
+
+
+class timed_phase(object):
+    """
+    Context manager adding the time spent in its block to `phase` of the
+    request's RequestTimer. A no-op when the request is not instrumented.
+    """
+
+    def __init__(self, environ, phase):
+        self.timer = environ.get(TIMER_ENV_KEY)
+        self.phase = phase
+
+    def __enter__(self):
+        if self.timer is not None:
+            self.started = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.phase, time.time() - self.started)
+
+
+class LatencyStats(object):
+    """Per-route, per-phase LatencyHistograms of one worker process."""
+
+    def __init__(self):
+        self.routes = {}
+
+    def record(self, timer):
+        route = self.routes.get(timer.route)
+        if route is None:
+            route = self.routes[timer.route] = {}
+        for phase, elapsed in timer.phases.iteritems():
+            hist = route.get(phase)
+            if hist is None:
+                hist = route[phase] = histogram.LatencyHistogram()
+            hist.record(elapsed)
+
+    def summary(self):
+        return dict((route, dict((phase, hist.summary())
+                                 for phase, hist in phases.iteritems()))
+                    for route, phases in self.routes.iteritems())
+
+
+class _TimedAppIter(object):
+    """Times how long the server takes to write out the response body."""
+
+    def __init__(self, app_iter, timer, stats):
+        self.app_iter = app_iter
+        self.timer = timer
+        self.stats = stats
+
+    def __iter__(self):
+        started = time.time()
+        try:
+            for chunk in self.app_iter:
+                yield chunk
+        finally:
+            self.timer.add('write', time.time() - started)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            timer = self.timer
+            timer.add('total', time.time() - timer.started)
+            self.stats.record(timer)
+
+
+class LatencyInstrumentation(Middleware):
+    """
+    Middleware breaking down request latency into routing,
+    deserialization, policy, controller, serialization and response write
+    time, keyed by route name ('unmatched' for requests no route took).
+
+    Each worker keeps its own LatencyStats, published as JSON on
+    `latency_admin_path` and logged every `latency_dump_interval` seconds.
+    """
+
+    def __init__(self, application, conf=None, **local_conf):
+        super(LatencyInstrumentation, self).__init__(application)
+        conf = conf or cfg.CONF
+        conf.register_opts(latency_opts)
+        self.admin_path = conf.latency_admin_path
+        self.dump_interval = conf.latency_dump_interval
+        self.stats = LatencyStats()
+        self._dumper_pid = None
+
+    def _start_dumper(self):
+        # NOTE(lakshmi): started lazily so each forked worker runs its own
+        self._dumper_pid = os.getpid()
+        if self.dump_interval > 0:
+            dumper = loopingcall.FixedIntervalLoopingCall(self.dump)
+            dumper.start(self.dump_interval, self.dump_interval)
+
+    def dump(self):
+        logging.info(_("Request latency (ms) for worker %(pid)s: %(stats)s"),
+                     {'pid': os.getpid(),
+                      'stats': json.dumps(self.stats.summary())})
+
+    def __call__(self, environ, start_response):
+        if self._dumper_pid != os.getpid():
+            self._start_dumper()
+        if environ.get('PATH_INFO') == self.admin_path:
+            response = webob.Response(content_type='application/json',
+                                      body=json.dumps(self.stats.summary()))
+            return response(environ, start_response)
+
+        timer = environ[TIMER_ENV_KEY] = RequestTimer()
+        app_iter = self.application(environ, start_response)
+        if timer.route is None:
+            timer.route = 'unmatched'
+        return _TimedAppIter(app_iter, timer, self.stats)
+
+
+def latency_filter(app, conf, **local_conf):
+    return LatencyInstrumentation(app, conf)
+
+
 class Router(object):
     """
     WSGI middleware that maps incoming requests to WSGI apps.
@@ -380,6 +723,80 @@ class Router(object):
         self.map = mapper
         self._router = routes.middleware.RoutesMiddleware(self._dispatch,
                                                           self.map)
+        self._table = self._compile(mapper)
+
+    @staticmethod
+    def _compile(mapper):
+        """
+        Compile the routes of `mapper` into a dispatch table of
+        {method: {segment count: [(pattern, route)]}}, with the key None
+        holding the routes that accept any method. Each list keeps the
+        mapper's order so the first matching route wins, as in routes.
+
+        Returns None when any route uses a feature the table cannot
+        express (requirements, partial-segment or greedy variables,
+        non-method conditions, minimization), in which case every request
+        goes through RoutesMiddleware.
+        """
+        if getattr(mapper, 'minimization', False):
+            return None
+        compiled = []
+        methods = set()
+        for route in mapper.matchlist:
+            if getattr(route, 'static', False):
+                continue
+            if route.reqs or not route.routepath.startswith('/'):
+                return None
+            conditions = route.conditions or {}
+            if set(conditions) - set(['method']):
+                return None
+            route_methods = conditions.get('method')
+            if isinstance(route_methods, basestring):
+                route_methods = [route_methods]
+
+            pattern = []
+            for segment in route.routepath.split('/')[1:]:
+                var = _ROUTE_VAR.match(segment)
+                if var:
+                    pattern.append((True, var.group(1)))
+                elif (not segment or '{' in segment or '}' in segment or
+                        segment[0] in ':*'):
+                    return None
+                else:
+                    pattern.append((False, segment))
+
+            compiled.append((route_methods, tuple(pattern), route))
+            methods.update(route_methods or ())
+
+        table = {}
+        for method in list(methods) + [None]:
+            by_length = table[method] = {}
+            for route_methods, pattern, route in compiled:
+                if route_methods is None or method in route_methods:
+                    by_length.setdefault(len(pattern), []).append(
+                        (pattern, route))
+        return table
+
+    def _match(self, environ):
+        """Return (route, match dict) for the request, or None."""
+        segments = environ['PATH_INFO'].split('/')[1:]
+        by_length = self._table.get(environ['REQUEST_METHOD'],
+                                    self._table[None])
+        for pattern, route in by_length.get(len(segments), ()):
+            for (is_var, value), segment in itertools.izip(pattern,
+                                                           segments):
+                if segment != value and not (is_var and segment):
+                    break
+            else:
+                match = dict(route.defaults)
+                encoding = getattr(self.map, 'encoding', 'utf-8')
+                errors = getattr(self.map, 'decode_errors', 'ignore')
+                for (is_var, name), segment in itertools.izip(pattern,
+                                                              segments):
+                    if is_var:
+                        match[name] = segment.decode(encoding, errors)
+                return route, match
+        return None
 
     @webob.dec.wsgify
     def __call__(self, req):
@@ -387,6 +804,25 @@ class Router(object):
         Route the incoming request to a controller based on self.map.
         If no match, return a 404.
         """
+        environ = req.environ
+        timer = environ.get(TIMER_ENV_KEY)
+        if timer is not None:
+            timer.begin('routing')
+
+        # NOTE(lakshmi): anything the table does not match, and form POSTs
+        # which may carry a _method override, get the full routes treatment
+        # so 404s and corner cases behave exactly as before.
+        if self._table is not None and not (
+                environ['REQUEST_METHOD'] == 'POST' and
+                req.content_type == 'application/x-www-form-urlencoded'):
+            result = self._match(environ)
+            if result is not None:
+                route, match = result
+                environ['wsgiorg.routing_args'] = ((), match)
+                environ['routes.route'] = route
+                environ['routes.url'] = routes.util.URLGenerator(self.map,
+                                                                 environ)
+                return self._dispatch
         return self._router
 
     @staticmethod
@@ -397,6 +833,9 @@ class Router(object):
         and putting the information into req.environ.  Either returns 404
         or the routed WSGI app's response.
         """
+        timer = req.environ.get(TIMER_ENV_KEY)
+        if timer is not None:
+            timer.end('routing')
         match = req.environ['wsgiorg.routing_args'][1]
         if not match:
             return webob.exc.HTTPNotFound()
@@ -452,7 +891,86 @@ def is_json_content_type(request):
     return False
 
 
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+# name -> (dumps, loads), and the names in order of preference
+_JSON_CODECS = {}
+_JSON_PREFERENCE = []
+
+
+def register_json_codec(name, dumps, loads, preferred=False):
+    """
+    Make a JSON codec available to the serializers.
+
+    :param dumps: callable encoding an object, datetimes included, to a
+                  string
+    :param loads: callable decoding a string, raising ValueError on
+                  invalid input
+    :param preferred: whether 'auto' should pick this codec over the ones
+                      already registered
+    """
+    _JSON_CODECS[name] = (dumps, loads)
+    if name in _JSON_PREFERENCE:
+        _JSON_PREFERENCE.remove(name)
+    if preferred:
+        _JSON_PREFERENCE.insert(0, name)
+    else:
+        _JSON_PREFERENCE.append(name)
+
+
+def get_json_codec(name=None):
+    """Return the (dumps, loads) pair of a codec, by default the configured
+    one."""
+    if name is None:
+        cfg.CONF.register_opts(json_opts)
+        name = cfg.CONF.json_codec
+    if name == 'auto':
+        name = _JSON_PREFERENCE[0]
+    try:
+        return _JSON_CODECS[name]
+    except KeyError:
+        raise RuntimeError(_("Unknown JSON codec %s") % name)
+
+
+def _register_json_codecs():
+    # Registered from slowest to fastest. Only orjson encodes datetimes
+    # natively, the others call back into _json_default for them.
+    register_json_codec('json',
+                        functools.partial(json.dumps, default=_json_default),
+                        json.loads)
+    try:
+        import simplejson
+        from simplejson import _speedups  # noqa
+    except ImportError:
+        pass
+    else:
+        register_json_codec('simplejson',
+                            functools.partial(simplejson.dumps,
+                                              default=_json_default),
+                            simplejson.loads, preferred=True)
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        register_json_codec('orjson',
+                            functools.partial(
+                                orjson.dumps,
+                                option=orjson.OPT_NON_STR_KEYS),
+                            orjson.loads, preferred=True)
+
+
+_register_json_codecs()
+
+
 class JSONRequestDeserializer(object):
+    def __init__(self):
+        self._loads = get_json_codec()[1]
+
     def has_body(self, request):
         """
         Returns whether a Webob.Request object will possess an entity body.
@@ -466,7 +984,7 @@ class JSONRequestDeserializer(object):
 
     def from_json(self, datastring):
         try:
-            return json.loads(datastring)
+            return self._loads(datastring)
         except ValueError as ex:
             raise webob.exc.HTTPBadRequest(str(ex))
 
@@ -478,15 +996,13 @@ class JSONRequestDeserializer(object):
 
 
 class JSONResponseSerializer(object):
+    def __init__(self):
+        self._dumps = get_json_codec()[0]
 
     def to_json(self, data):
-        def sanitizer(obj):
-            if isinstance(obj, datetime.datetime):
-                return obj.isoformat()
-            return obj
-
-        response = json.dumps(data, default=sanitizer)
-        logging.debug("JSON response : %s" % response)
+        response = self._dumps(data)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("JSON response : %s", response)
         return response
 
     def default(self, response, result):
@@ -528,7 +1044,8 @@ class XMLResponseSerializer(object):
         eltree = etree.Element(root)
         self.object_to_element(data.get(root), eltree)
         response = etree.tostring(eltree)
-        logging.debug("XML response : %s" % response)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("XML response : %s", response)
         return response
 
     def default(self, response, result):
@@ -564,12 +1081,17 @@ class Resource(object):
         self.controller = controller
         self.deserializer = deserializer
         self.serializer = serializer
+        # (type, action) -> name of the method handling the action
+        self._method_names = {}
 
     @webob.dec.wsgify(RequestClass=Request)
     def __call__(self, request):
         """WSGI method that controls (de)serialization and method dispatch."""
         action_args = self.get_action_args(request.environ)
         action = action_args.pop('action', None)
+        timer = request.environ.get(TIMER_ENV_KEY)
+        if timer is not None:
+            timer.route = action
 
         # From reading the boto code, and observation of real AWS api responses
         # it seems that the AWS api ignores the content-type in the html header
@@ -580,13 +1102,15 @@ class Resource(object):
         # ContentType=JSON results in a JSON serialized response...
         content_type = request.params.get("ContentType")
 
-        deserialized_request = self.dispatch(self.deserializer,
-                                             action, request)
+        with timed_phase(request.environ, 'deserialize'):
+            deserialized_request = self.dispatch(self.deserializer,
+                                                 action, request)
         action_args.update(deserialized_request)
 
         try:
-            action_result = self.dispatch(self.controller, action,
-                                          request, **action_args)
+            with timed_phase(request.environ, 'controller'):
+                action_result = self.dispatch(self.controller, action,
+                                              request, **action_args)
         except TypeError as err:
             logging.error(_('Exception handling resource: %s') % str(err))
             msg = _('The server could not comply with the request since\r\n'
@@ -622,7 +1146,8 @@ class Resource(object):
                     serializer = XMLResponseSerializer()
 
             response = webob.Response(request=request)
-            self.dispatch(serializer, action, response, action_result)
+            with timed_phase(request.environ, 'serialize'):
+                self.dispatch(serializer, action, response, action_result)
             return response
 
         # return unserializable result (typically an exception)
@@ -647,11 +1172,12 @@ class Resource(object):
 
     def dispatch(self, obj, action, *args, **kwargs):
         """Find action-specific method on self and call it."""
-        try:
-            method = getattr(obj, action)
-        except AttributeError:
-            method = getattr(obj, 'default')
-        return method(*args, **kwargs)
+        key = (type(obj), action)
+        name = self._method_names.get(key)
+        if name is None:
+            name = action if hasattr(obj, action) else 'default'
+            self._method_names[key] = name
+        return getattr(obj, name)(*args, **kwargs)
 
     def get_action_args(self, request_environment):
         """Parse dictionary created by routes library."""
@@ -0,0 +1,63 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import socket
+
+from oslo.config import cfg
+
+INGEST_TOPIC = 'matra.ingest'
+
+# Register options for the ingest workers
+INGEST_OPTS = [
+    cfg.BoolOpt('use_rpc',
+                default=False,
+                help='Have the API cast validated batches to the ingest '
+                     'workers instead of writing them to storage itself',
+                ),
+    cfg.StrOpt('topic',
+               default=INGEST_TOPIC,
+               help='RPC topic the ingest workers consume batches from',
+               ),
+    cfg.StrOpt('host',
+               default=socket.gethostname(),
+               help='Name of this node, used for its host-specific topic',
+               ),
+    cfg.IntOpt('workers',
+               default=1,
+               help='Number of ingest worker processes',
+               ),
+    cfg.FloatOpt('coalesce_interval',
+                 default=0.5,
+                 help='Seconds a worker coalesces batches before writing '
+                      'them to storage',
+                 ),
+    cfg.IntOpt('coalesce_max_datapoints',
+               default=10000,
+               help='Datapoints that trigger an early write of the '
+                    'coalesced batches',
+               ),
+    cfg.BoolOpt('route_by_tenant',
+                default=False,
+                help='Cast batches on topics keyed by tenant, so the zmq '
+                     'ring matchmaker sends all batches of a tenant to the '
+                     'same worker. Only for rpc_backend impl_zmq with '
+                     'MatchMakerRing',
+                ),
+]
+
+CONF = cfg.CONF
+opt_group = cfg.OptGroup(name='ingest',
+                         title='Options for matra ingest workers')
+CONF.register_group(opt_group)
+CONF.register_opts(INGEST_OPTS, opt_group)
@@ -0,0 +1,54 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Client side of the ingest worker RPC API
+"""
+
+from oslo.config import cfg
+
+from matra import ingest  # noqa
+from matra.openstack.common.rpc import matchmaker_ring
+from matra.openstack.common.rpc import proxy
+
+
+class IngestAPI(proxy.RpcProxy):
+    '''
+    Client side of the ingest worker RPC API.
+
+    API version history:
+
+        1.0 - Initial version.
+    '''
+
+    BASE_RPC_API_VERSION = '1.0'
+
+    def __init__(self, topic=None):
+        super(IngestAPI, self).__init__(
+            topic=topic or cfg.CONF.ingest.topic,
+            default_version=self.BASE_RPC_API_VERSION)
+
+    def ingest_metrics(self, ctxt, datapoints):
+        '''
+        Hand a validated batch of datapoints to an ingest worker.
+
+        :param datapoints: list of dicts with tenant_id, metric_name,
+                           timestamp and value, all of one tenant
+        '''
+        topic = None
+        if cfg.CONF.ingest.route_by_tenant and datapoints:
+            topic = matchmaker_ring.keyed_topic(
+                self.topic, datapoints[0]['tenant_id'])
+        return self.cast(ctxt, self.make_msg('ingest_metrics',
+                                             datapoints=datapoints),
+                         topic=topic)
@@ -0,0 +1,107 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Ingest worker service: consumes batches cast by the API and writes them
+to storage
+"""
+
+import eventlet
+from oslo.config import cfg
+
+from matra import ingest  # noqa
+from matra.ingest import rpcapi
+from matra import storage
+from matra.openstack.common import log
+from matra.openstack.common.rpc import service as rpc_service
+
+LOG = log.getLogger(__name__)
+
+# Pending datapoints, in coalesce_max_datapoints, past which batches are
+# handed back to the queue
+PENDING_LIMIT_FACTOR = 4
+
+
+class IngestService(rpc_service.Service):
+    '''
+    Coalesce the batches received over RPC and write them to storage
+    every `coalesce_interval` seconds, or as soon as
+    `coalesce_max_datapoints` are pending.
+
+    Casts are acknowledged on receipt, so batches still pending when a
+    worker dies are lost; stop() writes them out on a clean shutdown.
+    A batch that fails to write is kept and retried on the next timer
+    flush. Once PENDING_LIMIT_FACTOR times `coalesce_max_datapoints` are
+    pending, new batches are cast back to the topic instead of being held.
+    '''
+
+    RPC_API_VERSION = '1.0'
+
+    def __init__(self, host, topic):
+        super(IngestService, self).__init__(host, topic)
+        self.conf = cfg.CONF.ingest
+        self.storage_conn = None
+        self._pending = []
+        self._failing = False
+        self._limit = self.conf.coalesce_max_datapoints * PENDING_LIMIT_FACTOR
+        self._requeue_api = rpcapi.IngestAPI(topic)
+
+    def start(self):
+        self.storage_conn = storage.get_connection(cfg.CONF)
+        super(IngestService, self).start()
+        self.tg.add_timer(self.conf.coalesce_interval, self.flush,
+                          self.conf.coalesce_interval)
+
+    def stop(self):
+        # Stop consuming first, so no cast arrives after the last flush.
+        # Closing the connection waits for the handlers in flight.
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.flush()
+        # Closing the connection again is a no-op
+        super(IngestService, self).stop()
+
+    def ingest_metrics(self, context, datapoints):
+        if len(self._pending) >= self._limit:
+            # Casts are acked on receipt, so rather than holding on to
+            # more while storage is behind, give it a flush interval and
+            # hand the batch back to the queue. Handlers waiting here
+            # fill the RPC thread pool, which holds back the consumer.
+            eventlet.sleep(self.conf.coalesce_interval)
+            if len(self._pending) >= self._limit:
+                LOG.warn(_('%d datapoints pending, requeueing a batch of '
+                           '%d'), len(self._pending), len(datapoints))
+                self._requeue_api.ingest_metrics(context, datapoints)
+                return
+        self._pending.extend(datapoints)
+        # While storage is failing, leave retries to the timer
+        if (len(self._pending) >= self.conf.coalesce_max_datapoints and
+                not self._failing):
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            self.storage_conn.ingest_metrics(batch)
+        except Exception:
+            LOG.exception(_('Failed to write %d datapoints, will retry'),
+                          len(batch))
+            # Keep the batch ahead of anything received meanwhile
+            self._pending[:0] = batch
+            self._failing = True
+        else:
+            self._failing = False
@@ -44,6 +44,7 @@ class Connection(base.Connection):
     # TODO (lakshmi): Fetch these from configs
     CASS_KEYSPACE='DATA'
     METRICS_FULL_CF='metrics_5m'
+    WATERMARKS_CF='metric_watermarks'
 
     def __init__(self, conf):
         # TODO (lakshmi): Support in memory connections for testing
@@ -80,3 +81,43 @@ class Connection(base.Connection):
 
     def ingest_metrics(self, data):
         pass
+
+    def get_metric_data(self, tenant_id, metric_name, start, end):
+        '''
+        Yield (timestamp, value) pairs of a metric between start and end,
+        in time order
+        '''
+        cf = pycassa.ColumnFamily(self.conn_pool, self.METRICS_FULL_CF)
+        key = ':'.join([tenant_id, metric_name])
+        try:
+            for ts, value in cf.xget(key, column_start=start,
+                                     column_finish=end):
+                yield ts, float(value)
+        except pycassa.NotFoundException:
+            return
+
+
+    def count_metric_data(self, tenant_id, metric_name, start, end,
+                          limit=None):
+        '''
+        Return the number of datapoints of a metric between start and end,
+        counting no further than `limit`. Cassandra counts the columns
+        itself, nothing is decoded here.
+        '''
+        cf = pycassa.ColumnFamily(self.conn_pool, self.METRICS_FULL_CF)
+        key = ':'.join([tenant_id, metric_name])
+        return cf.get_count(key, column_start=start, column_finish=end,
+                            max_count=limit)
+
+    def get_metric_watermark(self, tenant_id, metric_name):
+        '''
+        Return the time of the last write to a metric, or None if it
+        was never written. Writers bump it on every batch, including
+        backfills.
+        '''
+        cf = pycassa.ColumnFamily(self.conn_pool, self.WATERMARKS_CF)
+        key = ':'.join([tenant_id, metric_name])
+        try:
+            return float(cf.get(key, columns=['last_write'])['last_write'])
+        except pycassa.NotFoundException:
+            return None
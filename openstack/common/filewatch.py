@@ -0,0 +1,235 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Push notification of file changes.
+
+A greenthread per process watches files with inotify on Linux, or by
+polling their stat where inotify isn't available, and bumps the generation
+of a file whenever it changes. Readers compare that generation with the
+one they loaded instead of stat()ing the file on every call, and may also
+subscribe callbacks.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+import eventlet
+from eventlet import hubs
+from oslo.config import cfg
+
+from heat.openstack.common.gettextutils import _  # noqa
+from heat.openstack.common import log as logging
+
+filewatch_opts = [
+    cfg.BoolOpt('file_watch_inotify',
+                default=True,
+                help='Watch files with inotify where available'),
+    cfg.FloatOpt('file_watch_poll_interval',
+                 default=1.0,
+                 help='Seconds between checks of watched files when '
+                      'inotify is not used'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(filewatch_opts)
+
+LOG = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Directories are watched rather than files, so that files replaced by a
+# rename, as editors and config management do, are still followed.
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE)
+_EVENT = struct.Struct('iIII')
+
+
+class WatchedFile(object):
+    """A watched path and the number of changes seen to it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.callbacks = []
+
+    def changed(self):
+        self.generation += 1
+        for callback in self.callbacks:
+            try:
+                callback(self.path)
+            except Exception:
+                LOG.exception(_("File watch callback for %s failed"),
+                              self.path)
+
+
+class _Inotify(object):
+    """Minimal inotify binding over libc."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), _('inotify_init1 failed'))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          _('inotify_add_watch failed for %s') % path)
+        return wd
+
+    def read_events(self):
+        """Wait for events, return (wd, mask, name) tuples."""
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+                break
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                hubs.trampoline(self.fd, read=True)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+
+class FileWatcher(object):
+    """Watch files of this process, notifying on change."""
+
+    def __init__(self):
+        self.files = {}
+        # (watch descriptor, name in directory) -> path
+        self._names = {}
+        # path -> last stat, for files polled
+        self._polled = {}
+        self._reader = None
+        self._poller = None
+        self._inotify = None
+        if CONF.file_watch_inotify:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError, TypeError) as e:
+                LOG.info(_("inotify unavailable, polling watched files: "
+                           "%s"), e)
+
+    def watch(self, path, callback=None):
+        """Return the WatchedFile of `path`, watching it if needed."""
+        path = os.path.abspath(path)
+        watched = self.files.get(path)
+        if watched is None:
+            watched = self.files[path] = WatchedFile(path)
+            self._add(path)
+        if callback is not None:
+            watched.callbacks.append(callback)
+        return watched
+
+    def _add(self, path):
+        if self._inotify is not None:
+            directory, name = os.path.split(path)
+            try:
+                wd = self._inotify.add_watch(directory, _WATCH_MASK)
+            except OSError as e:
+                LOG.warn(_("Can't watch %(dir)s, polling it: %(err)s"),
+                         {'dir': directory, 'err': e})
+            else:
+                self._names[(wd, name)] = path
+                if self._reader is None:
+                    self._reader = eventlet.spawn(self._read)
+                return
+
+        self._polled[path] = self._stat(path)
+        if self._poller is None:
+            self._poller = eventlet.spawn(self._poll)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _poll(self):
+        while True:
+            eventlet.sleep(CONF.file_watch_poll_interval)
+            for path, state in self._polled.items():
+                current = self._stat(path)
+                if current != state:
+                    self._polled[path] = current
+                    self.files[path].changed()
+
+    def _read(self):
+        while True:
+            try:
+                events = self._inotify.read_events()
+            except OSError:
+                LOG.exception(_("Reading inotify events failed"))
+                eventlet.sleep(CONF.file_watch_poll_interval)
+                continue
+            changed = set()
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, assume everything changed
+                    changed.update(self._names.itervalues())
+                    continue
+                path = self._names.get((wd, name))
+                if path is not None:
+                    changed.add(path)
+            for path in changed:
+                self.files[path].changed()
+
+
+_WATCHER = None
+_WATCHER_PID = None
+
+
+def get_watcher():
+    """Return the FileWatcher of this process.
+
+    Watchers are per process, as forked workers don't inherit the
+    greenthread of their parent.
+    """
+    global _WATCHER, _WATCHER_PID
+    if _WATCHER is None or _WATCHER_PID != os.getpid():
+        _WATCHER = FileWatcher()
+        _WATCHER_PID = os.getpid()
+    return _WATCHER
+
+
+def watch(path, callback=None):
+    """Watch `path`, see FileWatcher.watch()."""
+    return get_watcher().watch(path, callback)
@@ -29,8 +29,10 @@ It also allows setting of formatting information through conf.
 
 """
 
+import collections
 import inspect
 import itertools
+import json
 import logging
 import logging.config
 import logging.handlers
@@ -38,6 +40,8 @@ import os
 import sys
 import traceback
 
+import eventlet
+from eventlet import patcher
 from oslo.config import cfg
 from six import moves
 
@@ -140,6 +144,28 @@ log_opts = [
     cfg.BoolOpt('fatal_deprecations',
                 default=False,
                 help='make deprecations fatal'),
+    cfg.BoolOpt('log_queue',
+                default=False,
+                help='hand log records to a background thread which writes '
+                     'them to the file, syslog and stream handlers'),
+    cfg.IntOpt('log_queue_size',
+               default=10000,
+               help='log records the background writer may fall behind by'),
+    cfg.StrOpt('log_queue_overflow',
+               default='drop',
+               help='what to do with records when the log queue is full: '
+                    'drop them, or block until there is room'),
+    cfg.IntOpt('log_queue_batch_size',
+               default=100,
+               help='log records written between flushes of the handlers'),
+    cfg.ListOpt('log_json_fields',
+                default=[],
+                help='fields written by JSONFormatter, all of them if '
+                     'empty'),
+    cfg.BoolOpt('log_json_epoch_time',
+                default=False,
+                help='have JSONFormatter write asctime as seconds since the '
+                     'epoch rather than a formatted date'),
 
     # NOTE(mikal): there are two options here because sometimes we are handed
     # a full instance (and could include more information), and other times we
@@ -276,11 +302,70 @@ class ContextAdapter(BaseLoggerAdapter):
         return msg, kwargs
 
 
+def _json_traceback(formatter, record):
+    if record.exc_info:
+        return formatter.formatException(record.exc_info)
+    return None
+
+
+def _json_asctime(formatter, record):
+    if formatter.epoch_time:
+        return record.created
+    return formatter.formatTime(record, formatter.datefmt)
+
+
 class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line.
+
+    Only the fields in log_json_fields are written. The fields that are
+    the same for every record of a logger in a process are encoded once
+    and reused; the others go through a single C-accelerated encoder.
+    """
+
+    # Field name -> function(formatter, record), in output order
+    FIELDS = collections.OrderedDict([
+        ('message', lambda f, r: r.getMessage()),
+        ('asctime', _json_asctime),
+        ('name', lambda f, r: r.name),
+        ('msg', lambda f, r: r.msg),
+        ('args', lambda f, r: r.args),
+        ('levelname', lambda f, r: r.levelname),
+        ('levelno', lambda f, r: r.levelno),
+        ('pathname', lambda f, r: r.pathname),
+        ('filename', lambda f, r: r.filename),
+        ('module', lambda f, r: r.module),
+        ('lineno', lambda f, r: r.lineno),
+        ('funcname', lambda f, r: r.funcName),
+        ('created', lambda f, r: r.created),
+        ('msecs', lambda f, r: r.msecs),
+        ('relative_created', lambda f, r: r.relativeCreated),
+        ('thread', lambda f, r: r.thread),
+        ('thread_name', lambda f, r: r.threadName),
+        ('process_name', lambda f, r: r.processName),
+        ('process', lambda f, r: r.process),
+        ('traceback', _json_traceback),
+    ])
+    # Fields that only change with the logger or the process
+    STATIC_FIELDS = ('name', 'process_name', 'process')
+    MAX_CACHED_LOGGERS = 1024
+
     def __init__(self, fmt=None, datefmt=None):
         # NOTE(jkoelker) we ignore the fmt argument, but its still there
         #                since logging.config.fileConfig passes it.
         self.datefmt = datefmt
+        self.epoch_time = CONF.log_json_epoch_time
+        fields = CONF.log_json_fields or self.FIELDS.keys() + ['extra']
+        unknown = set(fields) - set(self.FIELDS) - set(['extra'])
+        if unknown:
+            raise ValueError(_('Unknown JSON log fields: %s') %
+                             ', '.join(sorted(unknown)))
+        self.with_extra = 'extra' in fields
+        self._static = [(k, g) for k, g in self.FIELDS.iteritems()
+                        if k in fields and k in self.STATIC_FIELDS]
+        self._dynamic = [(k, g) for k, g in self.FIELDS.iteritems()
+                         if k in fields and k not in self.STATIC_FIELDS]
+        self._encoder = json.JSONEncoder(default=jsonutils.to_primitive)
+        self._prefixes = {}
 
     def formatException(self, ei, strip_newlines=True):
         lines = traceback.format_exception(*ei)
@@ -291,35 +376,174 @@ class JSONFormatter(logging.Formatter):
             lines = list(itertools.chain(*lines))
         return lines
 
+    def _prefix(self, record):
+        """Return the encoded static fields of the record's logger."""
+        key = (record.name, record.process)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            if len(self._prefixes) >= self.MAX_CACHED_LOGGERS:
+                self._prefixes.clear()
+            # Encode as an object and keep the members only
+            prefix = self._encoder.encode(dict(
+                (k, getter(self, record)) for k, getter in self._static))
+            prefix = self._prefixes[key] = prefix[1:-1]
+        return prefix
+
     def format(self, record):
-        message = {'message': record.getMessage(),
-                   'asctime': self.formatTime(record, self.datefmt),
-                   'name': record.name,
-                   'msg': record.msg,
-                   'args': record.args,
-                   'levelname': record.levelname,
-                   'levelno': record.levelno,
-                   'pathname': record.pathname,
-                   'filename': record.filename,
-                   'module': record.module,
-                   'lineno': record.lineno,
-                   'funcname': record.funcName,
-                   'created': record.created,
-                   'msecs': record.msecs,
-                   'relative_created': record.relativeCreated,
-                   'thread': record.thread,
-                   'thread_name': record.threadName,
-                   'process_name': record.processName,
-                   'process': record.process,
-                   'traceback': None}
-
-        if hasattr(record, 'extra'):
+        message = {}
+        for k, getter in self._dynamic:
+            message[k] = getter(self, record)
+        if self.with_extra and hasattr(record, 'extra'):
             message['extra'] = record.extra
 
-        if record.exc_info:
-            message['traceback'] = self.formatException(record.exc_info)
+        body = self._encoder.encode(message)
+        prefix = self._prefix(record)
+        if not prefix:
+            return body
+        if body == '{}':
+            return '{%s}' % prefix
+        return '{%s, %s' % (prefix, body[1:])
+
+
+# Real threads and queues, even when eventlet has monkey patched them
+_threading = patcher.original('threading')
+_queue = patcher.original('Queue')
+
 
-        return jsonutils.dumps(message)
+class QueuedHandler(logging.Handler):
+    """Hand records to a native thread that writes them to `handlers`.
+
+    Emitting only puts the record on a bounded queue, so a slow disk or
+    syslog doesn't stall the greenthread that logs. When the queue is full
+    the record is dropped and counted, or with block=True the caller waits
+    (yielding to other greenthreads) for room. The writer takes records in
+    batches of up to batch_size and flushes the handlers once per batch.
+
+    The writer is the only thread calling the wrapped handlers, so it
+    bypasses their locks. A process forked after setup starts a writer and
+    queue of its own on its first record.
+    """
+
+    def __init__(self, handlers, maxsize=10000, block=False, batch_size=100):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.block = block
+        self.batch_size = max(batch_size, 1)
+        self.dropped = 0
+        self.written = 0
+        self._reported_dropped = 0
+        self._pid = None
+        self.queue = None
+        self._thread = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self.queue = _queue.Queue(self.maxsize)
+        self._thread = _threading.Thread(target=self._run,
+                                         name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        # Putting on the queue is thread-safe, the handler lock isn't needed
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        # Arguments may change once the caller moves on, so render the
+        # message now
+        try:
+            record.msg = record.getMessage()
+        except Exception:
+            self.handleError(record)
+            return
+        record.args = None
+        if not self.block:
+            try:
+                self.queue.put_nowait(record)
+            except _queue.Full:
+                self.dropped += 1
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except _queue.Full:
+                # Yield to the other greenthreads while the writer drains
+                eventlet.sleep(0.001)
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level and handler.filter(record):
+                handler.emit(record)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except _queue.Empty:
+                pass
+            stop = False
+            for record in batch:
+                if record is None:
+                    # Closing, flush what was written before stopping
+                    stop = True
+                    break
+                try:
+                    self._write(record)
+                except Exception:
+                    # Handlers report their own errors; keep writing
+                    pass
+                self.written += 1
+            if self.dropped > self._reported_dropped:
+                self._report_dropped()
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except Exception:
+                    pass
+            if stop:
+                return
+
+    def _report_dropped(self):
+        dropped = self.dropped - self._reported_dropped
+        self._reported_dropped = self.dropped
+        record = logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                   'Log queue full, dropped %d records',
+                                   (dropped,), None)
+        self._write(record)
+
+    def stats(self):
+        """Return the records queued, written and dropped by this process."""
+        return {'queued': self.queue.qsize() if self.queue else 0,
+                'written': self.written,
+                'dropped': self.dropped}
+
+    def close(self):
+        """Write out the queued records and stop the writer."""
+        if self._thread is not None and self._pid == os.getpid():
+            try:
+                self.queue.put(None, timeout=5)
+                self._thread.join(5)
+            except _queue.Full:
+                pass
+            self._thread = None
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def queue_stats():
+    """Return the stats of the QueuedHandlers of the root logger."""
+    return [handler.stats() for handler in logging.getLogger().handlers
+            if isinstance(handler, QueuedHandler)]
 
 
 def _create_logging_excepthook(product_name):
@@ -416,11 +640,13 @@ def _setup_logging_from_conf():
         streamlog = logging.StreamHandler(sys.stdout)
         log_root.addHandler(streamlog)
 
+    publish_handler = None
     if CONF.publish_errors:
         handler = importutils.import_object(
             "heat.openstack.common.log_handler.PublishErrorsHandler",
             logging.ERROR)
         log_root.addHandler(handler)
+        publish_handler = handler
 
     datefmt = CONF.log_date_format
     for handler in log_root.handlers:
@@ -434,6 +660,18 @@ def _setup_logging_from_conf():
         else:
             handler.setFormatter(ContextFormatter(datefmt=datefmt))
 
+    if CONF.log_queue:
+        # Errors are still published from the logging greenthread, as the
+        # notifier isn't safe to call from the writer thread
+        writers = [h for h in log_root.handlers if h is not publish_handler]
+        for handler in writers:
+            log_root.removeHandler(handler)
+        log_root.addHandler(QueuedHandler(
+            writers,
+            maxsize=CONF.log_queue_size,
+            block=CONF.log_queue_overflow == 'block',
+            batch_size=CONF.log_queue_batch_size))
+
     if CONF.debug:
         log_root.setLevel(logging.DEBUG)
     elif CONF.verbose:
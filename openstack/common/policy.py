@@ -57,6 +57,8 @@ as it allows particular rules to be explicitly disabled.
 """
 
 import abc
+import collections
+import os
 import re
 import urllib
 import urllib2
@@ -65,6 +67,7 @@ from oslo.config import cfg
 import six
 
 from heat.openstack.common import fileutils
+from heat.openstack.common import filewatch
 from heat.openstack.common.gettextutils import _  # noqa
 from heat.openstack.common import jsonutils
 from heat.openstack.common import log as logging
@@ -76,6 +79,10 @@ policy_opts = [
     cfg.StrOpt('policy_default_rule',
                default='default',
                help=_('Rule enforced when requested rule is not found')),
+    cfg.IntOpt('policy_cache_size',
+               default=4096,
+               help=_('Number of policy decisions cached per enforcer, '
+                      '0 disables the cache')),
 ]
 
 CONF = cfg.CONF
@@ -164,6 +171,38 @@ class Enforcer(object):
 
         self.policy_path = None
         self.policy_file = policy_file or CONF.policy_file
+        self._policy_watch = None
+        self._policy_watch_pid = None
+        self._loaded_generation = None
+
+        self.cache_size = CONF.policy_cache_size
+        self._compile_rules()
+
+    def _compile_rules(self):
+        """Compile the rules and drop the decisions made with the old ones."""
+        self._compiled = dict((name, rule.compile())
+                              for name, rule in self.rules.items())
+        self._decisions = collections.OrderedDict()
+        self._cacheable = {}
+
+    def check_rule(self, name, target, creds):
+        """Evaluate the compiled rule `name`, failing closed if unknown."""
+        try:
+            check = self._compiled[name]
+        except KeyError:
+            try:
+                # Rules fall back to the default rule
+                check = self._compiled[name] = self.rules[name].compile()
+            except KeyError:
+                LOG.debug(_("Rule [%s] doesn't exist") % name)
+                # If the rule doesn't exist, fail closed
+                return False
+        try:
+            return check(target, creds, self)
+        except KeyError:
+            # A key missing from the target or creds fails closed too
+            LOG.debug(_("Rule [%s] references a missing key") % name)
+            return False
 
     def set_rules(self, rules, overwrite=True):
         """Create a new Rules object based on the provided dict of rules.
@@ -181,26 +220,43 @@ class Enforcer(object):
             self.rules = Rules(rules, self.default_rule)
         else:
             self.rules.update(rules)
+        self._compile_rules()
 
     def clear(self):
         """Clears Enforcer rules, policy's cache and policy's path."""
         self.set_rules({})
         self.default_rule = None
         self.policy_path = None
+        self._policy_watch = None
+        self._policy_watch_pid = None
+        self._loaded_generation = None
 
     def load_rules(self, force_reload=False):
         """Loads policy_path's rules.
 
-        Policy file is cached and will be reloaded if modified.
+        Policy file is watched and will be reloaded if modified; as long as
+        it isn't, this only compares the file's change generation.
 
         :param force_reload: Whether to overwrite current rules.
         """
 
         if not self.policy_path:
             self.policy_path = self._get_policy_path()
-
+        if self._policy_watch is None or self._policy_watch_pid != os.getpid():
+            # Watches are per process, so is the generation last loaded
+            self._policy_watch = filewatch.watch(self.policy_path)
+            self._policy_watch_pid = os.getpid()
+            self._loaded_generation = None
+
+        generation = self._policy_watch.generation
+        if (not force_reload and self.rules and
+                generation == self._loaded_generation):
+            return
+
+        changed = force_reload or generation != self._loaded_generation
+        self._loaded_generation = generation
         reloaded, data = fileutils.read_cached_file(self.policy_path,
-                                                    force_reload=force_reload)
+                                                    force_reload=changed)
         if reloaded or not self.rules:
             rules = Rules.load_json(data, self.default_rule)
             self.set_rules(rules)
@@ -256,18 +312,15 @@ class Enforcer(object):
 
         # Allow the rule to be a Check tree
         if isinstance(rule, BaseCheck):
-            result = rule(target, creds, self)
+            try:
+                result = rule(target, creds, self)
+            except KeyError:
+                result = False
         elif not self.rules:
             # No rules to reference means we're going to fail closed
             result = False
         else:
-            try:
-                # Evaluate the rule
-                result = self.rules[rule](target, creds, self)
-            except KeyError:
-                LOG.debug(_("Rule [%s] doesn't exist") % rule)
-                # If the rule doesn't exist, fail closed
-                result = False
+            result = self._enforce_cached(rule, target, creds)
 
         # If it is False, raise the exception if requested
         if do_raise and not result:
@@ -278,6 +331,51 @@ class Enforcer(object):
 
         return result
 
+    def _enforce_cached(self, rule, target, creds):
+        """Evaluate a named rule, reusing the decision for the same input."""
+        key = None
+        if self.cache_size > 0 and self._is_cacheable(rule):
+            try:
+                key = (rule, _fingerprint(creds), _fingerprint(target))
+                return self._decisions[key]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable values can't be cached
+                key = None
+
+        result = self.check_rule(rule, target, creds)
+        if key is not None:
+            if len(self._decisions) >= self.cache_size:
+                self._decisions.popitem(last=False)
+            self._decisions[key] = result
+        return result
+
+
+    def _is_cacheable(self, rule):
+        """Whether decisions of a named rule only depend on their input."""
+        try:
+            return self._cacheable[rule]
+        except KeyError:
+            cacheable = self._cacheable[rule] = RuleCheck(
+                'rule', rule).cacheable(self.rules, frozenset())
+            return cacheable
+
+
+def _fingerprint(value):
+    """Return a hashable equivalent of a target or credentials dict.
+
+    Values keep their type, as True, 1 and 1.0 are equal but checks may
+    tell them apart.
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((k, _fingerprint(v))
+                                   for k, v in value.iteritems())))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_fingerprint(v) for v in value))
+    hash(value)
+    return (type(value), value)
+
 
 class BaseCheck(object):
     """Abstract base class for Check classes."""
@@ -300,6 +398,28 @@ class BaseCheck(object):
 
         pass
 
+    def compile(self):
+        """Return a function(target, cred, enforcer) doing this check.
+
+        Subclasses return closures with the work that doesn't depend on
+        the target or credentials done up front; by default the check is
+        just called.
+        """
+
+        return self
+
+    def cacheable(self, rules, seen):
+        """Whether the check is a function of the target and creds only.
+
+        Decisions of rules relying on anything else, a remote server or a
+        user-defined check, must not be cached.
+
+        :param rules: The rules referenced rules are looked up in.
+        :param seen: Names of the rules being looked at already.
+        """
+
+        return False
+
 
 class FalseCheck(BaseCheck):
     """A policy check that always returns False (disallow)."""
@@ -314,6 +434,12 @@ class FalseCheck(BaseCheck):
 
         return False
 
+    def compile(self):
+        return lambda target, cred, enforcer: False
+
+    def cacheable(self, rules, seen):
+        return True
+
 
 class TrueCheck(BaseCheck):
     """A policy check that always returns True (allow)."""
@@ -328,6 +454,12 @@ class TrueCheck(BaseCheck):
 
         return True
 
+    def compile(self):
+        return lambda target, cred, enforcer: True
+
+    def cacheable(self, rules, seen):
+        return True
+
 
 class Check(BaseCheck):
     """A base class to allow for user-defined policy checks."""
@@ -377,6 +509,14 @@ class NotCheck(BaseCheck):
 
         return not self.rule(target, cred, enforcer)
 
+    def compile(self):
+        check = self.rule.compile()
+        return lambda target, cred, enforcer: not check(target, cred,
+                                                        enforcer)
+
+    def cacheable(self, rules, seen):
+        return self.rule.cacheable(rules, seen)
+
 
 class AndCheck(BaseCheck):
     """Implements the "and" logical operator.
@@ -404,11 +544,25 @@ class AndCheck(BaseCheck):
         """
 
         for rule in self.rules:
-            if not rule(target, cred):
+            if not rule(target, cred, enforcer):
                 return False
 
         return True
 
+    def compile(self):
+        checks = tuple(rule.compile() for rule in self.rules)
+
+        def _and(target, cred, enforcer):
+            for check in checks:
+                if not check(target, cred, enforcer):
+                    return False
+            return True
+
+        return _and
+
+    def cacheable(self, rules, seen):
+        return all(rule.cacheable(rules, seen) for rule in self.rules)
+
     def add_check(self, rule):
         """Adds rule to be tested.
 
@@ -447,11 +601,25 @@ class OrCheck(BaseCheck):
         """
 
         for rule in self.rules:
-            if rule(target, cred):
+            if rule(target, cred, enforcer):
                 return True
 
         return False
 
+    def compile(self):
+        checks = tuple(rule.compile() for rule in self.rules)
+
+        def _or(target, cred, enforcer):
+            for check in checks:
+                if check(target, cred, enforcer):
+                    return True
+            return False
+
+        return _or
+
+    def cacheable(self, rules, seen):
+        return all(rule.cacheable(rules, seen) for rule in self.rules)
+
     def add_check(self, rule):
         """Adds rule to be tested.
 
@@ -808,13 +976,44 @@ class RuleCheck(Check):
             # We don't have any matching rule; fail closed
             return False
 
+    def compile(self):
+        name = self.match
+        # Resolved on each call, so the rule may be redefined later
+        return lambda target, creds, enforcer: enforcer.check_rule(
+            name, target, creds)
+
+    def cacheable(self, rules, seen):
+        if self.match in seen:
+            return True
+        try:
+            rule = rules[self.match]
+        except KeyError:
+            # Unknown rules always fail closed
+            return True
+        return rule.cacheable(rules, seen | frozenset([self.match]))
+
 
 @register("role")
 class RoleCheck(Check):
     def __call__(self, target, creds, enforcer):
         """Check that there is a matching role in the cred dict."""
 
-        return self.match.lower() in [x.lower() for x in creds['roles']]
+        return self.match.lower() in [x.lower()
+                                      for x in creds.get('roles', [])]
+
+    def compile(self):
+        role = self.match.lower()
+
+        def _role(target, creds, enforcer):
+            for x in creds.get('roles', ()):
+                if x.lower() == role:
+                    return True
+            return False
+
+        return _role
+
+    def cacheable(self, rules, seen):
+        return True
 
 
 @register('http')
@@ -846,7 +1045,35 @@ class GenericCheck(Check):
         """
 
         # TODO(termie): do dict inspection via dot syntax
-        match = self.match % target
+        try:
+            match = self.match % target
+        except KeyError:
+            # While doing GenericCheck if key not
+            # present in Target return false
+            return False
         if self.kind in creds:
             return match == six.text_type(creds[self.kind])
         return False
+
+    def compile(self):
+        kind = self.kind
+        match = self.match
+        if '%' in match:
+            def _generic(target, creds, enforcer):
+                if kind in creds:
+                    try:
+                        return match % target == six.text_type(creds[kind])
+                    except KeyError:
+                        return False
+                return False
+        else:
+            # Nothing to interpolate from the target
+            def _generic(target, creds, enforcer):
+                if kind in creds:
+                    return match == six.text_type(creds[kind])
+                return False
+
+        return _generic
+
+    def cacheable(self, rules, seen):
+        return True
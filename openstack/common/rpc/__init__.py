@@ -70,6 +70,24 @@ rpc_opts = [
     cfg.StrOpt('control_exchange',
                default='openstack',
                help='AMQP exchange to connect to if using RabbitMQ or Qpid'),
+    cfg.StrOpt('rpc_envelope_version',
+               default='2.0',
+               help='Highest RPC envelope version to send. Set to 2.1 for '
+                    'msgpack-encoded payloads on drivers that carry binary '
+                    'data, or 2.2 to also compress large ones, once every '
+                    'peer understands it.'),
+    cfg.IntOpt('rpc_compress_threshold',
+               default=65536,
+               help='Encoded payloads larger than this many bytes are '
+                    'compressed when the envelope version allows it, '
+                    '0 disables compression'),
+    cfg.StrOpt('rpc_compression',
+               default='zlib',
+               help='Codec compressing large payloads, zlib or lz4. lz4 '
+                    'must be installed on every peer.'),
+    cfg.IntOpt('rpc_compress_level',
+               default=1,
+               help='zlib level used to compress large payloads'),
 ]
 
 CONF = cfg.CONF
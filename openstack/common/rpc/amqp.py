@@ -25,11 +25,13 @@ Specifically, this includes impl_kombu and impl_qpid.  impl_carrot also uses
 AMQP, but is deprecated and predates this code.
 """
 
-import collections
 import inspect
+import os
 import sys
+import time
 import uuid
 
+import eventlet
 from eventlet import greenpool
 from eventlet import pools
 from eventlet import queue
@@ -52,6 +54,26 @@ amqp_opts = [
     cfg.BoolOpt('amqp_auto_delete',
                 default=False,
                 help='Auto-delete queues in amqp.'),
+    cfg.IntOpt('amqp_dedupe_window',
+               default=200000,
+               help='Number of recent message ids remembered to drop '
+                    'redelivered messages.'),
+    cfg.ListOpt('rpc_topic_pool_sizes',
+                default=[],
+                help='topic:size pairs overriding rpc_thread_pool_size for '
+                     'the consumers of a topic.'),
+    cfg.IntOpt('rpc_conn_pool_min_size',
+               default=1,
+               help='Idle connections the RPC connection pool keeps open; '
+                    'it grows up to rpc_conn_pool_size on demand.'),
+    cfg.IntOpt('rpc_conn_pool_idle_timeout',
+               default=60,
+               help='Seconds an idle pooled connection is kept above '
+                    'rpc_conn_pool_min_size.'),
+    cfg.BoolOpt('rpc_conn_pool_check',
+                default=True,
+                help='Discard dead connections when they are taken from '
+                     'the pool.'),
 ]
 
 cfg.CONF.register_opts(amqp_opts)
@@ -61,23 +83,134 @@ LOG = logging.getLogger(__name__)
 
 
 class Pool(pools.Pool):
-    """Class that implements a Pool of Connections."""
+    """Class that implements a Pool of Connections.
+
+    The pool opens connections as they are asked for, up to max_size, and
+    closes those left idle for longer than rpc_conn_pool_idle_timeout while
+    more than rpc_conn_pool_min_size are open. A greenthread retires them
+    even when the pool is no longer used. Idle connections are checked
+    when taken out, so a caller never gets one the broker has dropped.
+    """
     def __init__(self, conf, connection_cls, *args, **kwargs):
         self.connection_cls = connection_cls
         self.conf = conf
         kwargs.setdefault("max_size", self.conf.rpc_conn_pool_size)
         kwargs.setdefault("order_as_stack", True)
         super(Pool, self).__init__(*args, **kwargs)
+        # Connections are opened on demand only
+        self.min_size = min(self.conf.rpc_conn_pool_min_size, self.max_size)
+        self.idle_timeout = self.conf.rpc_conn_pool_idle_timeout
+        self.check = self.conf.rpc_conn_pool_check
         self.reply_proxy = None
+        # Idle connections are kept as (connection, idle since) pairs, most
+        # recently used last
+        self._started = time.time()
+        self.created = 0
+        self.retired = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._reaper_pid = None
+
+    def _start_reaper(self):
+        # Started lazily, so that each forked process runs its own
+        self._reaper_pid = os.getpid()
+        if self.idle_timeout > 0:
+            eventlet.spawn_n(self._reap)
+
+    def _reap(self):
+        interval = max(self.idle_timeout / 2.0, 1)
+        pid = os.getpid()
+        while self._reaper_pid == pid:
+            eventlet.sleep(interval)
+            self._retire_idle(time.time())
 
-    # TODO(comstud): Timeout connections not used in a while
     def create(self):
         LOG.debug(_('Pool creating new connection'))
         return self.connection_cls(self.conf)
 
+    def _discard(self, conn):
+        self.current_size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
+        healthy = getattr(conn, 'is_healthy', None)
+        return healthy is None or healthy()
+
+    def _retire_idle(self, now):
+        """Close the connections idle for too long, oldest first."""
+        while (self.free_items and self.current_size > self.min_size and
+               now - self.free_items[0][1] > self.idle_timeout):
+            conn, _idle = self.free_items.popleft()
+            LOG.debug(_('Pool retiring idle connection'))
+            self.retired += 1
+            self._discard(conn)
+
+    def get(self):
+        """Return a connection, opening one or waiting if there is none."""
+        start = time.time()
+        self._retire_idle(start)
+        conn = None
+        while self.free_items:
+            conn, _idle = self.free_items.pop()
+            if not self.check or self._healthy(conn):
+                break
+            LOG.info(_('Pool discarding dead connection'))
+            self._discard(conn)
+            conn = None
+        if conn is None:
+            if self.current_size < self.max_size:
+                self.current_size += 1
+                try:
+                    conn = self.create()
+                except Exception:
+                    self.current_size -= 1
+                    raise
+                self.created += 1
+            else:
+                conn = self.channel.get()
+        waited = time.time() - start
+        self.checkouts += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def put(self, conn):
+        """Hand a connection to a waiting caller, or keep it idle."""
+        if self.current_size > self.max_size:
+            self._discard(conn)
+            return
+        if self.waiting():
+            self.channel.put(conn)
+            return
+        now = time.time()
+        self.free_items.append((conn, now))
+        self._retire_idle(now)
+        if self._reaper_pid != os.getpid():
+            self._start_reaper()
+
+    def stats(self):
+        """Return the pool size, checkout wait times and creation rate."""
+        elapsed = max(time.time() - self._started, 1)
+        return {'size': self.current_size,
+                'in_use': self.current_size - len(self.free_items),
+                'idle': len(self.free_items),
+                'waiting': self.waiting(),
+                'created': self.created,
+                'created_per_minute': self.created * 60.0 / elapsed,
+                'retired': self.retired,
+                'checkouts': self.checkouts,
+                'mean_wait_time': (self.wait_time / self.checkouts
+                                   if self.checkouts else 0.0),
+                'max_wait_time': self.max_wait_time}
+
     def empty(self):
         while self.free_items:
-            self.get().close()
+            conn, _idle = self.free_items.pop()
+            conn.close()
         # Force a new connection pool to be created.
         # Note that this was added due to failing unit test cases. The issue
         # is the above "while loop" gets all the cached connections from the
@@ -216,8 +349,8 @@ class ReplyProxy(ConnectionContext):
         self._call_waiters[msg_id] = waiter
 
     def del_call_waiter(self, msg_id):
-        self._num_call_waiters -= 1
-        del self._call_waiters[msg_id]
+        if self._call_waiters.pop(msg_id, None) is not None:
+            self._num_call_waiters -= 1
 
     def get_reply_q(self):
         return self._reply_q
@@ -244,9 +377,9 @@ def msg_reply(conf, msg_id, reply_q, connection_pool, reply=None,
         # Otherwise use the msg_id for backward compatibilty.
         if reply_q:
             msg['_msg_id'] = msg_id
-            conn.direct_send(reply_q, rpc_common.serialize_msg(msg))
+            conn.direct_send(reply_q, _serialize_msg(conn, msg))
         else:
-            conn.direct_send(msg_id, rpc_common.serialize_msg(msg))
+            conn.direct_send(msg_id, _serialize_msg(conn, msg))
 
 
 class RpcContext(rpc_common.CommonRpcContext):
@@ -306,27 +439,46 @@ def pack_context(msg, context):
 
 
 class _MsgIdCache(object):
-    """This class checks any duplicate messages."""
+    """This class checks any duplicate messages.
+
+    The ids seen last are kept in a ring buffer, which decides which id to
+    forget, and in a set, which answers lookups, so checking a message
+    costs the same whatever the window size. The ring only grows up to the
+    window size as messages come in.
+    """
 
-    # NOTE: This value is considered can be a configuration item, but
-    #       it is not necessary to change its value in most cases,
-    #       so let this value as static for now.
     DUP_MSG_CHECK_SIZE = 16
 
     def __init__(self, **kwargs):
-        self.prev_msgids = collections.deque([],
-                                             maxlen=self.DUP_MSG_CHECK_SIZE)
+        self.size = max(kwargs.get('size') or self.DUP_MSG_CHECK_SIZE, 1)
+        self.prev_msgids = set()
+        self._ring = []
+        self._next = 0
+        self.duplicates = 0
 
     def check_duplicate_message(self, message_data):
         """AMQP consumers may read same message twice when exceptions occur
            before ack is returned. This method prevents doing it.
         """
-        if UNIQUE_ID in message_data:
-            msg_id = message_data[UNIQUE_ID]
-            if msg_id not in self.prev_msgids:
-                self.prev_msgids.append(msg_id)
-            else:
-                raise rpc_common.DuplicateMessageError(msg_id=msg_id)
+        if UNIQUE_ID not in message_data:
+            return
+        msg_id = message_data[UNIQUE_ID]
+        if msg_id in self.prev_msgids:
+            self.duplicates += 1
+            raise rpc_common.DuplicateMessageError(msg_id=msg_id)
+        self.prev_msgids.add(msg_id)
+        if len(self._ring) < self.size:
+            self._ring.append(msg_id)
+            return
+        self.prev_msgids.discard(self._ring[self._next])
+        self._ring[self._next] = msg_id
+        self._next = (self._next + 1) % self.size
+
+
+def _serialize_msg(conn, msg):
+    """Envelope a message, in binary form if the connection carries it."""
+    return rpc_common.serialize_msg(msg,
+                                    getattr(conn, 'binary_envelope', False))
 
 
 def _add_unique_id(msg):
@@ -336,17 +488,64 @@ def _add_unique_id(msg):
     LOG.debug(_('UNIQUE_ID is %s.') % (unique_id))
 
 
+def _topic_pool_size(conf, topic):
+    """Size of the greenthread pool handling the messages of `topic`."""
+    for item in conf.rpc_topic_pool_sizes:
+        name, _sep, size = item.rpartition(':')
+        if name == topic:
+            try:
+                return int(size)
+            except ValueError:
+                LOG.warn(_('Invalid pool size in rpc_topic_pool_sizes: %s'),
+                         item)
+    return conf.rpc_thread_pool_size
+
+
 class _ThreadPoolWithWait(object):
     """Base class for a delayed invocation manager.
 
     Used by the Connection class to start up green threads
     to handle incoming messages.
+
+    Spawning blocks while the pool is full, which stops the consumer from
+    reading (and acking) more messages until a handler finishes.
     """
 
-    def __init__(self, conf, connection_pool):
-        self.pool = greenpool.GreenPool(conf.rpc_thread_pool_size)
+    def __init__(self, conf, connection_pool, topic=None):
+        self.topic = topic
+        self.pool = greenpool.GreenPool(_topic_pool_size(conf, topic))
         self.connection_pool = connection_pool
         self.conf = conf
+        self.in_flight = 0
+        self.handled = 0
+        self.handler_time = 0.0
+        self.max_handler_time = 0.0
+
+    def _run(self, func, *args):
+        self.in_flight += 1
+        start = time.time()
+        try:
+            func(*args)
+        finally:
+            elapsed = time.time() - start
+            self.in_flight -= 1
+            self.handled += 1
+            self.handler_time += elapsed
+            self.max_handler_time = max(self.max_handler_time, elapsed)
+
+    def spawn(self, func, *args):
+        """Run func(*args) in the pool, keeping the handler statistics."""
+        self.pool.spawn_n(self._run, func, *args)
+
+    def stats(self):
+        """Return in-flight messages and handler latency in seconds."""
+        return {'topic': self.topic,
+                'pool_size': self.pool.size,
+                'in_flight': self.in_flight,
+                'handled': self.handled,
+                'mean_handler_time': (self.handler_time / self.handled
+                                      if self.handled else 0.0),
+                'max_handler_time': self.max_handler_time}
 
     def wait(self):
         """Wait for all callback threads to exit."""
@@ -359,34 +558,37 @@ class CallbackWrapper(_ThreadPoolWithWait):
     Allows it to be invoked in a green thread.
     """
 
-    def __init__(self, conf, callback, connection_pool):
+    def __init__(self, conf, callback, connection_pool, topic=None):
         """Initiates CallbackWrapper object.
 
         :param conf: cfg.CONF instance
         :param callback: a callable (probably a function)
         :param connection_pool: connection pool as returned by
                                 get_connection_pool()
+        :param topic: topic consumed, selects the pool size
         """
         super(CallbackWrapper, self).__init__(
             conf=conf,
             connection_pool=connection_pool,
+            topic=topic,
         )
         self.callback = callback
 
     def __call__(self, message_data):
-        self.pool.spawn_n(self.callback, message_data)
+        self.spawn(self.callback, message_data)
 
 
 class ProxyCallback(_ThreadPoolWithWait):
     """Calls methods on a proxy object based on method and args."""
 
-    def __init__(self, conf, proxy, connection_pool):
+    def __init__(self, conf, proxy, connection_pool, topic=None):
         super(ProxyCallback, self).__init__(
             conf=conf,
             connection_pool=connection_pool,
+            topic=topic,
         )
         self.proxy = proxy
-        self.msg_id_cache = _MsgIdCache()
+        self.msg_id_cache = _MsgIdCache(size=conf.amqp_dedupe_window)
 
     def __call__(self, message_data):
         """Consumer callback to call a method on a proxy object.
@@ -417,8 +619,8 @@ class ProxyCallback(_ThreadPoolWithWait):
             ctxt.reply(_('No method for message: %s') % message_data,
                        connection_pool=self.connection_pool)
             return
-        self.pool.spawn_n(self._process_data, ctxt, version, method,
-                          namespace, args)
+        self.spawn(self._process_data, ctxt, version, method, namespace,
+                   args)
 
     def _process_data(self, ctxt, version, method, namespace, args):
         """Process a message in a new thread.
@@ -466,7 +668,7 @@ class MulticallProxyWaiter(object):
         self._dataqueue = queue.LightQueue()
         # Add this caller to the reply proxy's call_waiters
         self._reply_proxy.add_call_waiter(self, self._msg_id)
-        self.msg_id_cache = _MsgIdCache()
+        self.msg_id_cache = _MsgIdCache(size=conf.amqp_dedupe_window)
 
     def put(self, data):
         self._dataqueue.put(data)
@@ -492,26 +694,34 @@ class MulticallProxyWaiter(object):
         return result
 
     def __iter__(self):
-        """Return a result until we get a reply with an 'ending' flag."""
+        """Return a result until we get a reply with an 'ending' flag.
+
+        The timeout applies to each reply. A caller which stops iterating
+        early, or is killed while waiting, is removed from the reply proxy
+        when the iterator is closed, so late replies are just dropped.
+        """
         if self._done:
             raise StopIteration
-        while True:
-            try:
-                data = self._dataqueue.get(timeout=self._timeout)
-                result = self._process_data(data)
-            except queue.Empty:
-                self.done()
-                raise rpc_common.Timeout()
-            except Exception:
-                with excutils.save_and_reraise_exception():
+        try:
+            while True:
+                try:
+                    data = self._dataqueue.get(timeout=self._timeout)
+                    result = self._process_data(data)
+                except queue.Empty:
+                    self.done()
+                    raise rpc_common.Timeout()
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        self.done()
+                if self._got_ending:
+                    self.done()
+                    raise StopIteration
+                if isinstance(result, Exception):
                     self.done()
-            if self._got_ending:
-                self.done()
-                raise StopIteration
-            if isinstance(result, Exception):
-                self.done()
-                raise result
-            yield result
+                    raise result
+                yield result
+        finally:
+            self.done()
 
 
 def create_connection(conf, new, connection_pool):
@@ -537,7 +747,7 @@ def multicall(conf, context, topic, msg, timeout, connection_pool):
     msg.update({'_reply_q': connection_pool.reply_proxy.get_reply_q()})
     wait_msg = MulticallProxyWaiter(conf, msg_id, timeout, connection_pool)
     with ConnectionContext(conf, connection_pool) as conn:
-        conn.topic_send(topic, rpc_common.serialize_msg(msg), timeout)
+        conn.topic_send(topic, _serialize_msg(conn, msg), timeout)
     return wait_msg
 
 
@@ -557,7 +767,7 @@ def cast(conf, context, topic, msg, connection_pool):
     _add_unique_id(msg)
     pack_context(msg, context)
     with ConnectionContext(conf, connection_pool) as conn:
-        conn.topic_send(topic, rpc_common.serialize_msg(msg))
+        conn.topic_send(topic, _serialize_msg(conn, msg))
 
 
 def fanout_cast(conf, context, topic, msg, connection_pool):
@@ -566,7 +776,7 @@ def fanout_cast(conf, context, topic, msg, connection_pool):
     _add_unique_id(msg)
     pack_context(msg, context)
     with ConnectionContext(conf, connection_pool) as conn:
-        conn.fanout_send(topic, rpc_common.serialize_msg(msg))
+        conn.fanout_send(topic, _serialize_msg(conn, msg))
 
 
 def cast_to_server(conf, context, server_params, topic, msg, connection_pool):
@@ -575,7 +785,7 @@ def cast_to_server(conf, context, server_params, topic, msg, connection_pool):
     pack_context(msg, context)
     with ConnectionContext(conf, connection_pool, pooled=False,
                            server_params=server_params) as conn:
-        conn.topic_send(topic, rpc_common.serialize_msg(msg))
+        conn.topic_send(topic, _serialize_msg(conn, msg))
 
 
 def fanout_cast_to_server(conf, context, server_params, topic, msg,
@@ -585,7 +795,7 @@ def fanout_cast_to_server(conf, context, server_params, topic, msg,
     pack_context(msg, context)
     with ConnectionContext(conf, connection_pool, pooled=False,
                            server_params=server_params) as conn:
-        conn.fanout_send(topic, rpc_common.serialize_msg(msg))
+        conn.fanout_send(topic, _serialize_msg(conn, msg))
 
 
 def notify(conf, context, topic, msg, connection_pool, envelope):
@@ -20,10 +20,20 @@
 import copy
 import sys
 import traceback
+import zlib
 
 from oslo.config import cfg
 import six
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
 from heat.openstack.common.gettextutils import _  # noqa
 from heat.openstack.common import importutils
 from heat.openstack.common import jsonutils
@@ -64,11 +74,27 @@ payload.
 We will JSON encode the application message payload.  The message envelope,
 which includes the JSON encoded application message body, will be passed down
 to the messaging libraries as a dict.
+
+Version '2.1' has the same layout, but 'oslo.message' holds the payload
+encoded with msgpack, a binary string.  It is only sent by drivers that can
+carry binary data (see serialize_msg()) and when the rpc_envelope_version
+option allows it, so that peers only understanding '2.0' keep working until
+the whole deployment has been upgraded.
+
+Version '2.2' is a '2.1' envelope whose msgpack payload, when larger than
+rpc_compress_threshold, is compressed with the codec named by an
+'oslo.compression' key.
 '''
-_RPC_ENVELOPE_VERSION = '2.0'
+_RPC_ENVELOPE_VERSION = '2.2'
+_JSON_ENVELOPE_VERSION = '2.0'
+_MSGPACK_ENVELOPE_VERSION = '2.1'
+_COMPRESSED_ENVELOPE_VERSION = '2.2'
+_BINARY_ENVELOPE_VERSIONS = (_MSGPACK_ENVELOPE_VERSION,
+                             _COMPRESSED_ENVELOPE_VERSION)
 
 _VERSION_KEY = 'oslo.version'
 _MESSAGE_KEY = 'oslo.message'
+_COMPRESSION_KEY = 'oslo.compression'
 
 _REMOTE_POSTFIX = '_Remote'
 
@@ -456,10 +482,56 @@ def version_is_compatible(imp_version, version):
     return True
 
 
-def serialize_msg(raw_msg):
+def _compress(data):
+    """Compress a payload, returning the codec used and the result."""
+    if CONF.rpc_compression == 'lz4':
+        if lz4_frame is not None:
+            return 'lz4', lz4_frame.compress(data)
+        LOG.warning(_("lz4 is not installed, compressing with zlib"))
+    return 'zlib', zlib.compress(data, CONF.rpc_compress_level)
+
+
+def _decompress(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lz4' and lz4_frame is not None:
+        return lz4_frame.decompress(data)
+    raise RPCException(_("Unsupported RPC payload compression %s") % codec)
+
+
+def _msgpack_loads(data):
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except TypeError:
+        # msgpack < 0.5.2 only knows the encoding argument
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+def serialize_msg(raw_msg, binary=False):
+    """Wrap a message in the newest envelope the peers can handle.
+
+    :param binary: whether the driver can carry a binary 'oslo.message',
+                   which allows the msgpack encoded '2.1' and '2.2'
+                   envelopes
+    """
     # NOTE(russellb) See the docstring for _RPC_ENVELOPE_VERSION for more
     # information about this format.
-    msg = {_VERSION_KEY: _RPC_ENVELOPE_VERSION,
+    max_version = CONF.rpc_envelope_version
+    if (binary and msgpack is not None and
+            version_is_compatible(max_version, _MSGPACK_ENVELOPE_VERSION)):
+        payload = msgpack.packb(raw_msg, default=jsonutils.to_primitive)
+        threshold = CONF.rpc_compress_threshold
+        if (threshold > 0 and len(payload) > threshold and
+                version_is_compatible(max_version,
+                                      _COMPRESSED_ENVELOPE_VERSION)):
+            codec, payload = _compress(payload)
+            return {_VERSION_KEY: _COMPRESSED_ENVELOPE_VERSION,
+                    _MESSAGE_KEY: payload,
+                    _COMPRESSION_KEY: codec}
+        return {_VERSION_KEY: _MSGPACK_ENVELOPE_VERSION,
+                _MESSAGE_KEY: payload}
+
+    msg = {_VERSION_KEY: _JSON_ENVELOPE_VERSION,
            _MESSAGE_KEY: jsonutils.dumps(raw_msg)}
 
     return msg
@@ -501,9 +573,19 @@ def deserialize_msg(msg):
     # At this point we think we have the message envelope
     # format we were expecting. (#1.a above)
 
-    if not version_is_compatible(_RPC_ENVELOPE_VERSION, msg[_VERSION_KEY]):
-        raise UnsupportedRpcEnvelopeVersion(version=msg[_VERSION_KEY])
-
-    raw_msg = jsonutils.loads(msg[_MESSAGE_KEY])
+    version = msg[_VERSION_KEY]
+    if not version_is_compatible(_RPC_ENVELOPE_VERSION, version):
+        raise UnsupportedRpcEnvelopeVersion(version=version)
+
+    if version_is_compatible(_JSON_ENVELOPE_VERSION, version):
+        raw_msg = jsonutils.loads(msg[_MESSAGE_KEY])
+    elif msgpack is not None:
+        payload = msg[_MESSAGE_KEY]
+        codec = msg.get(_COMPRESSION_KEY)
+        if codec:
+            payload = _decompress(codec, payload)
+        raw_msg = _msgpack_loads(payload)
+    else:
+        raise UnsupportedRpcEnvelopeVersion(version=version)
 
     return raw_msg
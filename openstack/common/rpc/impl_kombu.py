@@ -14,14 +14,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import functools
 import itertools
 import socket
 import ssl
+import sys
 import time
 import uuid
 
 import eventlet
+from eventlet import event
+from eventlet import queue
 import greenlet
 import kombu
 import kombu.connection
@@ -91,6 +95,37 @@ kombu_opts = [
                 help='use H/A queues in RabbitMQ (x-ha-policy: all).'
                      'You need to wipe RabbitMQ database when '
                      'changing this option.'),
+    cfg.BoolOpt('rabbit_publish_batch',
+                default=False,
+                help='Group casts into batches published over a dedicated '
+                     'connection'),
+    cfg.FloatOpt('rabbit_publish_batch_window',
+                 default=0.005,
+                 help='Seconds a batch of casts stays open for more '
+                      'messages'),
+    cfg.IntOpt('rabbit_publish_batch_size',
+               default=100,
+               help='Messages that close a batch of casts early'),
+    cfg.BoolOpt('rabbit_publisher_confirms',
+                default=True,
+                help='Wait for the broker to confirm each batch of casts '
+                     'before returning to the callers'),
+    cfg.FloatOpt('rabbit_publisher_confirm_timeout',
+                 default=30.0,
+                 help='Seconds to wait for the broker to confirm a batch '
+                      'of casts before failing it'),
+    cfg.IntOpt('rabbit_prefetch_count',
+               default=0,
+               help='Unacknowledged messages the broker may deliver to a '
+                    'connection (basic.qos), 0 for no limit'),
+    cfg.IntOpt('rabbit_ack_batch_size',
+               default=1,
+               help='Handled messages acknowledged together with a single '
+                    'basic.ack'),
+    cfg.FloatOpt('rabbit_ack_flush_interval',
+                 default=0.5,
+                 help='Seconds an idle consumer holds back batched '
+                      'acknowledgements'),
 
 ]
 
@@ -131,6 +166,8 @@ class ConsumerBase(object):
         self.kwargs = kwargs
         self.queue = None
         self.ack_on_error = kwargs.get('ack_on_error', True)
+        # Set by the Connection when acks are batched
+        self.acks = None
         self.reconnect(channel)
 
     def reconnect(self, channel):
@@ -165,7 +202,12 @@ class ConsumerBase(object):
                 LOG.exception(_("Failed to process message"
                                 " ... will requeue."))
         finally:
-            if ack_msg:
+            if self.acks is not None:
+                if ack_msg:
+                    self.acks.ack(message)
+                else:
+                    self.acks.reject(message)
+            elif ack_msg:
                 message.ack()
             else:
                 message.reject()
@@ -309,6 +351,45 @@ class FanoutConsumer(ConsumerBase):
                                              **options)
 
 
+class AckBatcher(object):
+    """Acknowledge handled messages of a channel in batches.
+
+    Consumers hand messages over in delivery order and only once they are
+    handled, so acking the last one with multiple=True covers all of the
+    channel's earlier deliveries. A rejection first flushes the pending
+    acks so it doesn't get covered by a later multiple ack.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.channel = None
+        self.pending = 0
+        self._last_tag = None
+
+    def bind(self, channel):
+        """Start over on a new channel; tags of the old one are void."""
+        self.channel = channel
+        self.pending = 0
+        self._last_tag = None
+
+    def ack(self, message):
+        self._last_tag = message.delivery_tag
+        self.pending += 1
+        if self.pending >= self.size:
+            self.flush()
+
+    def reject(self, message):
+        self.flush()
+        message.reject()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.channel.basic_ack(self._last_tag, multiple=True)
+        self.pending = 0
+        self._last_tag = None
+
+
 class Publisher(object):
     """Base Publisher class."""
 
@@ -331,13 +412,18 @@ class Publisher(object):
 
     def send(self, msg, timeout=None):
         """Send a message."""
+        kwargs = {}
+        # A binary envelope cannot go through kombu's default JSON
+        # serializer; msgpack carries it as is.
+        if (isinstance(msg, dict) and msg.get(rpc_common._VERSION_KEY) in
+                rpc_common._BINARY_ENVELOPE_VERSIONS):
+            kwargs['serializer'] = 'msgpack'
         if timeout:
             #
             # AMQP TTL is in milliseconds when set in the header.
             #
-            self.producer.publish(msg, headers={'ttl': (timeout * 1000)})
-        else:
-            self.producer.publish(msg)
+            kwargs['headers'] = {'ttl': (timeout * 1000)}
+        self.producer.publish(msg, **kwargs)
 
 
 class DirectPublisher(Publisher):
@@ -418,6 +504,9 @@ class Connection(object):
 
     pool = None
 
+    # Publisher.send() switches kombu to msgpack for binary envelopes
+    binary_envelope = rpc_common.msgpack is not None
+
     def __init__(self, conf, server_params=None):
         self.consumers = []
         self.consumer_thread = None
@@ -432,6 +521,18 @@ class Connection(object):
         # max retry-interval = 30 seconds
         self.interval_max = 30
         self.memory_transport = False
+        # Topic and fanout publishers, reused across sends
+        self.publishers = {}
+        # Casts to another broker can't join the shared batches
+        self.batchable = not server_params
+        self.acks = None
+        ack_batch_size = self.conf.rabbit_ack_batch_size
+        if self.conf.rabbit_prefetch_count > 0:
+            # Holding back acks for a full window would stall delivery
+            ack_batch_size = min(ack_batch_size,
+                                 self.conf.rabbit_prefetch_count)
+        if ack_batch_size > 1:
+            self.acks = AckBatcher(ack_batch_size)
 
         if server_params is None:
             server_params = {}
@@ -519,11 +620,21 @@ class Connection(object):
         # work around 'memory' transport bug in 1.1.3
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
+        self._setup_channel()
         for consumer in self.consumers:
             consumer.reconnect(self.channel)
+        for publisher in self.publishers.itervalues():
+            publisher.reconnect(self.channel)
         LOG.info(_('Connected to AMQP server on %(hostname)s:%(port)d') %
                  params)
 
+    def _setup_channel(self):
+        """Apply the prefetch limit and ack batching to a new channel."""
+        if self.conf.rabbit_prefetch_count > 0:
+            self.channel.basic_qos(0, self.conf.rabbit_prefetch_count, False)
+        if self.acks is not None:
+            self.acks.bind(self.channel)
+
     def reconnect(self):
         """Handles reconnecting and re-establishing queues.
         Will retry up to self.max_retries number of times.
@@ -601,6 +712,30 @@ class Connection(object):
         """Convenience call for bin/clear_rabbit_queues."""
         return self.channel
 
+    def is_healthy(self):
+        """Whether the broker connection is still up.
+
+        The socket of a connection the broker or network dropped may still
+        look connected, so pending frames are read without waiting; that
+        fails on a dead socket.
+        """
+        if self.connection is None or not self.connection.connected:
+            return False
+        try:
+            self.connection.drain_events(timeout=0)
+        except socket.timeout:
+            pass
+        except socket.error as e:
+            # Transports setting a zero timeout make the socket
+            # non-blocking, nothing to read then is EAGAIN
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                LOG.info(_("Broker connection failed its check: %s"), e)
+                return False
+        except Exception as e:
+            LOG.info(_("Broker connection failed its check: %s"), e)
+            return False
+        return True
+
     def close(self):
         """Close/release this connection."""
         self.cancel_consumer_thread()
@@ -612,12 +747,16 @@ class Connection(object):
         """Reset a connection so it can be used again."""
         self.cancel_consumer_thread()
         self.wait_on_proxy_callbacks()
+        if self.acks is not None:
+            self.acks.flush()
         self.channel.close()
         self.channel = self.connection.channel()
         # work around 'memory' transport bug in 1.1.3
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
+        self._setup_channel()
         self.consumers = []
+        self.publishers = {}
 
     def declare_consumer(self, consumer_cls, topic, callback):
         """Create a Consumer using the class that was passed in and
@@ -632,6 +771,7 @@ class Connection(object):
         def _declare_consumer():
             consumer = consumer_cls(self.conf, self.channel, topic, callback,
                                     self.consumer_num.next())
+            consumer.acks = self.acks
             self.consumers.append(consumer)
             return consumer
 
@@ -660,6 +800,15 @@ class Connection(object):
                     queue.consume(nowait=True)
                 queues_tail.consume(nowait=False)
                 info['do_consume'] = False
+            if timeout is None and self.acks is not None and \
+                    self.acks.pending:
+                # Don't sit on handled messages while the queues are idle
+                try:
+                    return self.connection.drain_events(
+                        timeout=self.conf.rabbit_ack_flush_interval)
+                except socket.timeout:
+                    self.acks.flush()
+                    return
             return self.connection.drain_events(timeout=timeout)
 
         for iteration in itertools.count(0):
@@ -682,6 +831,10 @@ class Connection(object):
         for proxy_cb in self.proxy_callbacks:
             proxy_cb.wait()
 
+    def consumer_stats(self):
+        """Return the in-flight and latency statistics of each consumer."""
+        return [proxy_cb.stats() for proxy_cb in self.proxy_callbacks]
+
     def publisher_send(self, cls, topic, msg, timeout=None, **kwargs):
         """Send to a publisher based on the publisher class."""
 
@@ -691,11 +844,26 @@ class Connection(object):
                           "'%(topic)s': %(err_str)s") % log_info)
 
         def _publish():
-            publisher = cls(self.conf, self.channel, topic, **kwargs)
+            publisher = self.get_publisher(cls, topic, **kwargs)
             publisher.send(msg, timeout)
 
         self.ensure(_error_callback, _publish)
 
+    def get_publisher(self, cls, topic, **kwargs):
+        """Return a publisher, reusing the declared topic and fanout ones.
+
+        Direct publishers are keyed by a msg_id used once, and notify
+        publishers may carry options, so those are built every time.
+        """
+        if kwargs or cls not in (TopicPublisher, FanoutPublisher):
+            return cls(self.conf, self.channel, topic, **kwargs)
+        key = (cls, topic)
+        publisher = self.publishers.get(key)
+        if publisher is None:
+            publisher = self.publishers[key] = cls(self.conf, self.channel,
+                                                   topic)
+        return publisher
+
     def declare_direct_consumer(self, topic, callback):
         """Create a 'direct' queue.
         In nova's use, this is generally a msg_id queue used for
@@ -723,6 +891,11 @@ class Connection(object):
 
     def topic_send(self, topic, msg, timeout=None):
         """Send a 'topic' message."""
+        # Casts (no timeout) may join a batch; calls are sent right away
+        if timeout is None and self.batchable and \
+                self.conf.rabbit_publish_batch:
+            get_batch_publisher(self.conf).send(topic, msg)
+            return
         self.publisher_send(TopicPublisher, topic, msg, timeout)
 
     def fanout_send(self, topic, msg):
@@ -758,7 +931,8 @@ class Connection(object):
         """Create a consumer that calls a method in a proxy object."""
         proxy_cb = rpc_amqp.ProxyCallback(
             self.conf, proxy,
-            rpc_amqp.get_connection_pool(self.conf, Connection))
+            rpc_amqp.get_connection_pool(self.conf, Connection),
+            topic=topic)
         self.proxy_callbacks.append(proxy_cb)
 
         if fanout:
@@ -770,7 +944,8 @@ class Connection(object):
         """Create a worker that calls a method in a proxy object."""
         proxy_cb = rpc_amqp.ProxyCallback(
             self.conf, proxy,
-            rpc_amqp.get_connection_pool(self.conf, Connection))
+            rpc_amqp.get_connection_pool(self.conf, Connection),
+            topic=topic)
         self.proxy_callbacks.append(proxy_cb)
         self.declare_topic_consumer(topic, proxy_cb, pool_name)
 
@@ -789,6 +964,7 @@ class Connection(object):
             callback=callback,
             connection_pool=rpc_amqp.get_connection_pool(self.conf,
                                                          Connection),
+            topic=topic,
         )
         self.proxy_callbacks.append(callback_wrapper)
         self.declare_topic_consumer(
@@ -800,6 +976,157 @@ class Connection(object):
         )
 
 
+class BatchPublisher(object):
+    """Publish casts from all greenthreads in batches.
+
+    Messages queued within rabbit_publish_batch_window seconds of each other,
+    up to rabbit_publish_batch_size, are published back to back over a
+    dedicated connection reusing one publisher per topic. With publisher
+    confirms the batch is then confirmed as a whole, and each sender only
+    returns once the broker has confirmed its message. Senders of a batch
+    left unconfirmed for rabbit_publisher_confirm_timeout get an
+    RPCException.
+
+    A batch interrupted by a connection error is published again in full
+    after reconnecting, so receivers may see duplicates; amqp drops those
+    by their unique id.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.window = conf.rabbit_publish_batch_window
+        self.max_size = conf.rabbit_publish_batch_size
+        self.confirms = conf.rabbit_publisher_confirms
+        self.confirm_timeout = conf.rabbit_publisher_confirm_timeout
+        self.connection = None
+        self._queue = queue.LightQueue()
+        self._thread = None
+        self._confirmed_channel = None
+        self._acked = 0
+        self._nacked = False
+        self.batches = 0
+        self.messages = 0
+        self.largest_batch = 0
+
+    def send(self, topic, msg):
+        """Queue a message and wait until its batch has been published."""
+        if self._thread is None or self._thread.dead:
+            self._thread = eventlet.spawn(self._run)
+        done = event.Event()
+        self._queue.put((topic, msg, done))
+        return done.wait()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._flush(batch)
+            except BaseException:
+                exc_info = sys.exc_info()
+                for _topic, _msg, done in batch:
+                    done.send_exception(*exc_info)
+                if not isinstance(exc_info[1], Exception):
+                    # Killed, the next send() starts another thread
+                    raise
+            else:
+                for _topic, _msg, done in batch:
+                    done.send()
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._acked += 1 if not multiple else delivery_tag - self._acked
+
+    def _on_nack(self, delivery_tag, multiple):
+        self._nacked = True
+        self._on_ack(delivery_tag, multiple)
+
+    def _enable_confirms(self, channel):
+        """Put a fresh channel in confirm mode, if the transport can."""
+        if not self.confirms or not hasattr(channel, 'confirm_select'):
+            return False
+        if channel is not self._confirmed_channel:
+            channel.events['basic_ack'].add(self._on_ack)
+            channel.events['basic_nack'].add(self._on_nack)
+            channel.confirm_select()
+            self._confirmed_channel = channel
+            self._acked = 0
+        return True
+
+    def _discard_connection(self):
+        conn, self.connection = self.connection, None
+        self._confirmed_channel = None
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _flush(self, batch):
+        if self.connection is None:
+            self.connection = Connection(self.conf)
+        conn = self.connection
+
+        def _error_callback(exc):
+            LOG.exception(_("Failed to publish a batch of %(count)d "
+                            "messages: %(err_str)s"),
+                          {'count': len(batch), 'err_str': str(exc)})
+
+        def _publish_batch():
+            confirmed = self._enable_confirms(conn.channel)
+            expected = self._acked + len(batch)
+            self._nacked = False
+            for topic, msg, _done in batch:
+                conn.get_publisher(TopicPublisher, topic).send(msg)
+            if confirmed:
+                deadline = time.time() + self.confirm_timeout
+                while self._acked < expected:
+                    remaining = deadline - time.time()
+                    try:
+                        if remaining <= 0:
+                            raise socket.timeout()
+                        conn.connection.drain_events(timeout=remaining)
+                    except socket.timeout:
+                        # Confirms still due would count against the
+                        # next batch, so start over on a new connection
+                        self._discard_connection()
+                        raise rpc_common.RPCException(
+                            _("Broker did not confirm a batch of %(count)d "
+                              "messages within %(secs)s seconds") %
+                            {'count': len(batch),
+                             'secs': self.confirm_timeout})
+                if self._nacked:
+                    raise rpc_common.RPCException(
+                        _("Broker rejected a batch of %d messages") %
+                        len(batch))
+
+        conn.ensure(_error_callback, _publish_batch)
+        self.batches += 1
+        self.messages += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+
+
+_BATCH_PUBLISHER = None
+
+
+def get_batch_publisher(conf):
+    """Return the BatchPublisher of this process."""
+    global _BATCH_PUBLISHER
+    if _BATCH_PUBLISHER is None:
+        _BATCH_PUBLISHER = BatchPublisher(conf)
+    return _BATCH_PUBLISHER
+
+
 def create_connection(conf, new=True):
     """Create a connection."""
     return rpc_amqp.create_connection(
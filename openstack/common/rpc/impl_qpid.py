@@ -67,6 +67,9 @@ qpid_opts = [
     cfg.BoolOpt('qpid_tcp_nodelay',
                 default=True,
                 help='Disable Nagle algorithm'),
+    cfg.IntOpt('qpid_receiver_capacity',
+               default=1,
+               help='Messages each receiver prefetches from the broker'),
 ]
 
 cfg.CONF.register_opts(qpid_opts)
@@ -94,6 +97,7 @@ class ConsumerBase(object):
         self.callback = callback
         self.receiver = None
         self.session = None
+        self.capacity = 1
 
         addr_opts = {
             "create": "always",
@@ -132,7 +136,7 @@ class ConsumerBase(object):
     def _declare_receiver(self, session):
         self.session = session
         self.receiver = session.receiver(self.address)
-        self.receiver.capacity = 1
+        self.receiver.capacity = self.capacity
 
     def _unpack_json_msg(self, msg):
         """Load the JSON data in msg if msg.content_type indicates that it
@@ -408,6 +412,11 @@ class Connection(object):
     def _register_consumer(self, consumer):
         self.consumers[str(consumer.get_receiver())] = consumer
 
+    def _set_capacity(self, consumer):
+        """Let a consumer prefetch qpid_receiver_capacity messages."""
+        consumer.capacity = self.conf.qpid_receiver_capacity
+        consumer.get_receiver().capacity = consumer.capacity
+
     def _lookup_consumer(self, receiver):
         return self.consumers[str(receiver)]
 
@@ -462,6 +471,10 @@ class Connection(object):
                     error_callback(e)
                 self.reconnect()
 
+    def is_healthy(self):
+        """Whether the broker connection is still up."""
+        return self.connection is not None and self.connection.opened()
+
     def close(self):
         """Close/release this connection."""
         self.cancel_consumer_thread()
@@ -495,6 +508,7 @@ class Connection(object):
         def _declare_consumer():
             consumer = consumer_cls(self.conf, self.session, topic, callback)
             self._register_consumer(consumer)
+            self._set_capacity(consumer)
             return consumer
 
         return self.ensure(_connect_error, _declare_consumer)
@@ -538,6 +552,10 @@ class Connection(object):
         for proxy_cb in self.proxy_callbacks:
             proxy_cb.wait()
 
+    def consumer_stats(self):
+        """Return the in-flight and latency statistics of each consumer."""
+        return [proxy_cb.stats() for proxy_cb in self.proxy_callbacks]
+
     def publisher_send(self, cls, topic, msg):
         """Send to a publisher based on the publisher class."""
 
@@ -624,7 +642,8 @@ class Connection(object):
         """Create a consumer that calls a method in a proxy object."""
         proxy_cb = rpc_amqp.ProxyCallback(
             self.conf, proxy,
-            rpc_amqp.get_connection_pool(self.conf, Connection))
+            rpc_amqp.get_connection_pool(self.conf, Connection),
+            topic=topic)
         self.proxy_callbacks.append(proxy_cb)
 
         if fanout:
@@ -633,6 +652,7 @@ class Connection(object):
             consumer = TopicConsumer(self.conf, self.session, topic, proxy_cb)
 
         self._register_consumer(consumer)
+        self._set_capacity(consumer)
 
         return consumer
 
@@ -640,13 +660,15 @@ class Connection(object):
         """Create a worker that calls a method in a proxy object."""
         proxy_cb = rpc_amqp.ProxyCallback(
             self.conf, proxy,
-            rpc_amqp.get_connection_pool(self.conf, Connection))
+            rpc_amqp.get_connection_pool(self.conf, Connection),
+            topic=topic)
         self.proxy_callbacks.append(proxy_cb)
 
         consumer = TopicConsumer(self.conf, self.session, topic, proxy_cb,
                                  name=pool_name)
 
         self._register_consumer(consumer)
+        self._set_capacity(consumer)
 
         return consumer
 
@@ -665,6 +687,7 @@ class Connection(object):
             callback=callback,
             connection_pool=rpc_amqp.get_connection_pool(self.conf,
                                                          Connection),
+            topic=topic,
         )
         self.proxy_callbacks.append(callback_wrapper)
 
@@ -676,6 +699,7 @@ class Connection(object):
                                  exchange_name=exchange_name)
 
         self._register_consumer(consumer)
+        self._set_capacity(consumer)
         return consumer
 
 
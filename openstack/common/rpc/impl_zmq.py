@@ -72,7 +72,23 @@ zmq_opts = [
 
     cfg.StrOpt('rpc_zmq_host', default=socket.gethostname(),
                help='Name of this node. Must be a valid hostname, FQDN, or '
-                    'IP address. Must match "host" option, if running Nova.')
+                    'IP address. Must match "host" option, if running Nova.'),
+
+    cfg.IntOpt('rpc_zmq_sndhwm', default=0,
+               help='Messages queued per socket for sending before sends '
+                    'block or drop. 0 keeps the ZeroMQ default.'),
+
+    cfg.IntOpt('rpc_zmq_rcvhwm', default=0,
+               help='Messages queued per socket on receipt before peers '
+                    'are pushed back. 0 keeps the ZeroMQ default.'),
+
+    cfg.IntOpt('rpc_zmq_copy_threshold', default=65536,
+               help='Envelopes of at least this many bytes are sent as '
+                    'zero-copy frames'),
+
+    cfg.IntOpt('rpc_zmq_proxy_batch', default=64,
+               help='Messages the ZeroMQ proxy receives or forwards per '
+                    'wakeup'),
 ]
 
 
@@ -130,6 +146,8 @@ class ZmqSocket(object):
         for f in do_sub:
             self.subscribe(f)
 
+        self._set_hwm()
+
         str_data = {'addr': addr, 'type': self.socket_s(),
                     'subscribe': subscribe, 'bind': bind}
 
@@ -145,6 +163,16 @@ class ZmqSocket(object):
         except Exception:
             raise RPCException(_("Could not open socket."))
 
+    def _set_hwm(self):
+        """Apply the configured high-water marks, before connecting."""
+        # libzmq 2 has a single HWM covering both directions
+        sndhwm = getattr(zmq, 'SNDHWM', getattr(zmq, 'HWM', None))
+        rcvhwm = getattr(zmq, 'RCVHWM', getattr(zmq, 'HWM', None))
+        if self.can_send and CONF.rpc_zmq_sndhwm:
+            self.sock.setsockopt(sndhwm, CONF.rpc_zmq_sndhwm)
+        if self.can_recv and CONF.rpc_zmq_rcvhwm:
+            self.sock.setsockopt(rcvhwm, CONF.rpc_zmq_rcvhwm)
+
     def socket_s(self):
         """Get socket type as string."""
         t_enum = ('PUSH', 'PULL', 'PUB', 'SUB', 'REP', 'REQ', 'ROUTER',
@@ -220,10 +248,15 @@ class ZmqClient(object):
                            (msg_id, topic, 'cast', _serialize(data))))
             return
 
-        rpc_envelope = rpc_common.serialize_msg(data[1], envelope)
+        # Envelope items travel as separate frames, so the payload may be
+        # binary.
+        rpc_envelope = rpc_common.serialize_msg(data[1], binary=True)
         zmq_msg = reduce(lambda x, y: x + y, rpc_envelope.items())
-        self.outq.send(map(bytes,
-                       (msg_id, topic, 'impl_zmq_v2', data[0]) + zmq_msg))
+        frames = map(bytes, (msg_id, topic, 'impl_zmq_v2', data[0]) + zmq_msg)
+        # Small frames are cheaper to copy than to track; large payloads,
+        # such as ingest batches, are handed to ZeroMQ by reference.
+        copy = max(map(len, frames)) < CONF.rpc_zmq_copy_threshold
+        self.outq.send(frames, copy=copy)
 
     def close(self):
         self.outq.close()
@@ -419,9 +452,23 @@ class ZmqProxy(ZmqBaseReactor):
         self.topic_proxy = {}
 
     def consume(self, sock):
-        ipc_dir = CONF.rpc_zmq_ipc_dir
+        """Forward a batch of messages, frames untouched.
+
+        Frames are received without copying and only the topic frame is
+        read, so payloads are relayed as they came in. After a blocking
+        receive, up to rpc_zmq_proxy_batch more messages already waiting
+        are taken in without yielding.
+        """
+        self._forward(sock.recv(copy=False))
+        for i in xrange(CONF.rpc_zmq_proxy_batch - 1):
+            try:
+                data = sock.recv(copy=False, flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._forward(data)
 
-        data = sock.recv(copy=False)
+    def _forward(self, data):
+        ipc_dir = CONF.rpc_zmq_ipc_dir
         topic = data[1].bytes
 
         if topic.startswith('fanout~'):
@@ -462,9 +509,16 @@ class ZmqProxy(ZmqBaseReactor):
 
                 waiter.send(True)
 
+                backlog = self.topic_proxy[topic]
                 while(True):
-                    data = self.topic_proxy[topic].get()
-                    out_sock.send(data, copy=False)
+                    out_sock.send(backlog.get(), copy=False)
+                    # Drain what queued up meanwhile in one go
+                    for i in xrange(CONF.rpc_zmq_proxy_batch - 1):
+                        try:
+                            data = backlog.get_nowait()
+                        except eventlet.queue.Empty:
+                            break
+                        out_sock.send(data, copy=False)
 
             wait_sock_creation = eventlet.event.Event()
             eventlet.spawn(publisher, wait_sock_creation)
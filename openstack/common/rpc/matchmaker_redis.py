@@ -18,8 +18,13 @@ The MatchMaker classes should accept a Topic or Fanout exchange key and
 return keys for direct exchanges, per (approximate) AMQP parlance.
 """
 
+import random
+import time
+
+import eventlet
 from oslo.config import cfg
 
+from heat.openstack.common.gettextutils import _  # noqa
 from heat.openstack.common import importutils
 from heat.openstack.common import log as logging
 from heat.openstack.common.rpc import matchmaker as mm_common
@@ -37,6 +42,10 @@ matchmaker_redis_opts = [
     cfg.StrOpt('password',
                default=None,
                help='Password for Redis server. (optional)'),
+    cfg.FloatOpt('lookup_cache_ttl',
+                 default=2.0,
+                 help='Seconds the hosts of a topic are cached locally. '
+                      'Registrations elsewhere invalidate the cache early.'),
 ]
 
 CONF = cfg.CONF
@@ -46,6 +55,9 @@ CONF.register_group(opt_group)
 CONF.register_opts(matchmaker_redis_opts, opt_group)
 LOG = logging.getLogger(__name__)
 
+# Topics whose hosts changed are published here
+INVALIDATE_CHANNEL = 'matchmaker_redis.invalidate'
+
 
 class RedisExchange(mm_common.Exchange):
     def __init__(self, matchmaker):
@@ -60,35 +72,30 @@ class RedisTopicExchange(RedisExchange):
     i.e. "compute.host" sends a message to "compute" running on "host"
     """
     def run(self, topic):
-        while True:
-            member_name = self.redis.srandmember(topic)
-
-            if not member_name:
-                # If this happens, there are no
-                # longer any members.
-                break
-
-            if not self.matchmaker.is_alive(topic, member_name):
-                continue
-
-            host = member_name.split('.', 1)[1]
-            return [(member_name, host)]
-        return []
+        members = self.matchmaker.lookup(topic)
+        if not members:
+            return []
+        member_name = random.choice(members)
+        host = member_name.split('.', 1)[1]
+        return [(member_name, host)]
 
 
 class RedisFanoutExchange(RedisExchange):
     """Return a list of all hosts."""
     def run(self, topic):
         topic = topic.split('~', 1)[1]
-        hosts = self.redis.smembers(topic)
-        good_hosts = filter(
-            lambda host: self.matchmaker.is_alive(topic, host), hosts)
-
-        return [(x, x.split('.', 1)[1]) for x in good_hosts]
+        return [(x, x.split('.', 1)[1])
+                for x in self.matchmaker.lookup(topic)]
 
 
 class MatchMakerRedis(mm_common.HeartbeatMatchMakerBase):
-    """MatchMaker registering and looking-up hosts with a Redis server."""
+    """MatchMaker registering and looking-up hosts with a Redis server.
+
+    The live hosts of a topic are cached for lookup_cache_ttl seconds, so
+    routing a message doesn't go to Redis each time. Every change to the
+    hosts of a topic is also published on INVALIDATE_CHANNEL, dropping
+    the cached entry of every matchmaker right away.
+    """
     def __init__(self):
         super(MatchMakerRedis, self).__init__()
 
@@ -99,33 +106,101 @@ class MatchMakerRedis(mm_common.HeartbeatMatchMakerBase):
             host=CONF.matchmaker_redis.host,
             port=CONF.matchmaker_redis.port,
             password=CONF.matchmaker_redis.password)
+        self.cache_ttl = CONF.matchmaker_redis.lookup_cache_ttl
+        self._cache = {}
+        self._listener = None
 
         self.add_binding(mm_common.FanoutBinding(), RedisFanoutExchange(self))
         self.add_binding(mm_common.DirectBinding(), mm_common.DirectExchange())
         self.add_binding(mm_common.TopicBinding(), RedisTopicExchange(self))
 
+    def _listen(self):
+        """Drop cached topics as their hosts change, until killed."""
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._cache.pop(message['data'], None)
+            except redis.RedisError:
+                LOG.exception(_("Lost the matchmaker invalidation channel"))
+            # Changes may have been missed meanwhile
+            self._cache.clear()
+            eventlet.sleep(1)
+
+    def lookup(self, topic):
+        """Return the live members ("topic.host") of a topic."""
+        if self._listener is None and self.cache_ttl > 0:
+            self._listener = eventlet.spawn(self._listen)
+
+        now = time.time()
+        cached = self._cache.get(topic)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        members = list(self.redis.smembers(topic))
+        with self.redis.pipeline(transaction=False) as pipe:
+            for member in members:
+                pipe.ttl(member)
+            ttls = pipe.execute()
+
+        alive = []
+        for member, ttl in zip(members, ttls):
+            if self._ttl_alive(ttl):
+                alive.append(member)
+            else:
+                self.expire(topic, member)
+        if self.cache_ttl > 0:
+            self._cache[topic] = (now + self.cache_ttl, alive)
+        return alive
+
+    @staticmethod
+    def _ttl_alive(ttl):
+        # -1: key without heartbeat, -2 or None: key gone
+        return ttl is not None and ttl >= 0
+
+    def send_heartbeats(self):
+        """Refresh the TTL of every registration in one round trip."""
+        if not self.host_topic:
+            return
+        registrations = list(self.host_topic)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key, host in registrations:
+                pipe.expire('%s.%s' % (key, host),
+                            CONF.matchmaker_heartbeat_ttl)
+            results = pipe.execute()
+        for (key, host), refreshed in zip(registrations, results):
+            if not refreshed:
+                # The key might have been pruned. Re-register, creating
+                # a new key in Redis.
+                self.register(key, host)
+
     def ack_alive(self, key, host):
         topic = "%s.%s" % (key, host)
         if not self.redis.expire(topic, CONF.matchmaker_heartbeat_ttl):
             # If we could not update the expiration, the key
             # might have been pruned. Re-register, creating a new
             # key in Redis.
-            self.register(self.topic_host[host], host)
+            self.register(key, host)
 
     def is_alive(self, topic, host):
-        if self.redis.ttl(host) == -1:
+        if not self._ttl_alive(self.redis.ttl(host)):
             self.expire(topic, host)
             return False
         return True
 
     def expire(self, topic, host):
+        self._cache.pop(topic, None)
         with self.redis.pipeline() as pipe:
             pipe.multi()
             pipe.delete(host)
             pipe.srem(topic, host)
+            pipe.publish(INVALIDATE_CHANNEL, topic)
             pipe.execute()
 
     def backend_register(self, key, key_host):
+        self._cache.pop(key, None)
         with self.redis.pipeline() as pipe:
             pipe.multi()
             pipe.sadd(key, key_host)
@@ -134,12 +209,28 @@ class MatchMakerRedis(mm_common.HeartbeatMatchMakerBase):
             # care if it exists. Sets aren't viable
             # because only keys can expire.
             pipe.set(key_host, '')
+            pipe.expire(key_host, CONF.matchmaker_heartbeat_ttl)
+            pipe.publish(INVALIDATE_CHANNEL, key)
 
             pipe.execute()
 
+    def register(self, key, host):
+        """Register a host, setting its TTL in the same round trip."""
+        self.hosts.add(host)
+        self.host_topic[(key, host)] = host
+        self.backend_register(key, '.'.join((key, host)))
+
     def backend_unregister(self, key, key_host):
+        self._cache.pop(key, None)
         with self.redis.pipeline() as pipe:
             pipe.multi()
             pipe.srem(key, key_host)
             pipe.delete(key_host)
+            pipe.publish(INVALIDATE_CHANNEL, key)
             pipe.execute()
+
+    def stop_heartbeat(self):
+        super(MatchMakerRedis, self).stop_heartbeat()
+        if self._listener is not None:
+            self._listener.kill()
+            self._listener = None
@@ -18,11 +18,17 @@ The MatchMaker classes should except a Topic or Fanout exchange key and
 return keys for direct exchanges, per (approximate) AMQP parlance.
 """
 
+import bisect
+import hashlib
 import itertools
 import json
+import os
+import struct
 
 from oslo.config import cfg
 
+from heat.openstack.common import fileutils
+from heat.openstack.common import filewatch
 from heat.openstack.common.gettextutils import _  # noqa
 from heat.openstack.common import log as logging
 from heat.openstack.common.rpc import matchmaker as mm
@@ -35,34 +41,81 @@ matchmaker_opts = [
                deprecated_group='DEFAULT',
                default='/etc/oslo/matchmaker_ring.json',
                help='Matchmaker ring file (JSON)'),
+    cfg.IntOpt('virtual_nodes',
+               default=100,
+               help='Points each host takes on the consistent hash ring'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(matchmaker_opts, 'matchmaker_ring')
 LOG = logging.getLogger(__name__)
 
+# Separates a topic from the routing key of a keyed topic
+KEY_SEP = '@'
+
+
+def keyed_topic(topic, key):
+    """Return a topic routed by `key` on a consistent hash ring.
+
+    Messages for the same key (a tenant or metric id, for instance) go to
+    the same host for as long as it stays in the ring. The key is hashed
+    so it can't collide with the separators of topics. The topic may
+    contain dots, it is looked up in the ring file as is.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return '%s%s%s' % (topic, KEY_SEP, hashlib.md5(key).hexdigest())
+
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
 
 class RingExchange(mm.Exchange):
     """Match Maker where hosts are loaded from a static JSON formatted file.
 
     __init__ takes optional ring dictionary argument, otherwise
-    loads the ringfile from CONF.mathcmaker_ringfile.
+    loads the ringfile from CONF.mathcmaker_ringfile, and loads it again
+    whenever the file watcher reports a change.
     """
     def __init__(self, ring=None):
         super(RingExchange, self).__init__()
 
+        self.ringfile = None
         if ring:
-            self.ring = ring
+            self._load(ring)
         else:
-            fh = open(CONF.matchmaker_ring.ringfile, 'r')
-            self.ring = json.load(fh)
-            fh.close()
+            self.ringfile = CONF.matchmaker_ring.ringfile
+            self._watch = None
+            self._watch_pid = None
+            self._reload()
 
+    def _load(self, ring):
+        self.ring = ring
         self.ring0 = {}
         for k in self.ring.keys():
             self.ring0[k] = itertools.cycle(self.ring[k])
 
+    def _reload(self):
+        if self.ringfile is None:
+            return
+        if self._watch is None or self._watch_pid != os.getpid():
+            # Watches are per process, so is the generation last loaded
+            self._watch = filewatch.watch(self.ringfile)
+            self._watch_pid = os.getpid()
+            self._generation = None
+        generation = self._watch.generation
+        if generation == self._generation:
+            return
+        self._generation = generation
+        reloaded, data = fileutils.read_cached_file(self.ringfile,
+                                                    force_reload=True)
+        self._load(json.loads(data))
+
     def _ring_has(self, key):
+        self._reload()
         return key in self.ring0
 
 
@@ -82,6 +135,47 @@ class RoundRobinRingExchange(RingExchange):
         return [(key + '.' + host, host)]
 
 
+class ConsistentHashRingExchange(RoundRobinRingExchange):
+    """A Topic Exchange routing keyed topics on a consistent hash ring.
+
+    Every host of a topic takes virtual_nodes points on the ring, so adding
+    a host to a topic moves about 1/N of its keys. A keyed topic (see
+    keyed_topic()) goes to the host owning the first point after the key's
+    hash. Topics without a key are handed out round robin.
+    """
+    def __init__(self, ring=None):
+        self.vnodes = CONF.matchmaker_ring.virtual_nodes
+        super(ConsistentHashRingExchange, self).__init__(ring)
+
+    def _load(self, ring):
+        super(ConsistentHashRingExchange, self)._load(ring)
+        self.points = {}
+        for topic, hosts in ring.iteritems():
+            points = sorted((_hash('%s-%d' % (host, i)), host)
+                            for host in hosts for i in xrange(self.vnodes))
+            self.points[topic] = ([p[0] for p in points],
+                                  [p[1] for p in points])
+
+    def run(self, key):
+        topic, _sep, route = key.partition(KEY_SEP)
+        if not route:
+            return super(ConsistentHashRingExchange, self).run(key)
+        if not self._ring_has(topic):
+            LOG.warn(
+                _("No key defining hosts for topic '%s', "
+                  "see ringfile") % (topic, )
+            )
+            return []
+
+        hashes, hosts = self.points[topic]
+        if not hashes:
+            return []
+        host = hosts[bisect.bisect(hashes, _hash(route)) % len(hosts)]
+        # Consumers listen on the part of their topic before the first dot,
+        # suffixed by their host (see impl_zmq.Connection.create_consumer)
+        return [(topic.split('.', 1)[0] + '.' + host, host)]
+
+
 class FanoutRingExchange(RingExchange):
     """Fanout Exchange based on a hashmap."""
     def __init__(self, ring=None):
@@ -99,10 +193,20 @@ class FanoutRingExchange(RingExchange):
         return map(lambda x: (key + '.' + x, x), self.ring[nkey])
 
 
+class KeyedBinding(mm.Binding):
+    """Match on keyed topics (see keyed_topic()), dotted or not."""
+    def test(self, key):
+        return KEY_SEP in key
+
+
 class MatchMakerRing(mm.MatchMakerBase):
     """Match Maker where hosts are loaded from a static hashmap."""
     def __init__(self, ring=None):
         super(MatchMakerRing, self).__init__()
+        topics = ConsistentHashRingExchange(ring)
+        # Ahead of DirectBinding, which would take a dotted keyed topic
+        # for a host
+        self.add_binding(KeyedBinding(), topics)
         self.add_binding(mm.FanoutBinding(), FanoutRingExchange(ring))
         self.add_binding(mm.DirectBinding(), mm.DirectExchange())
-        self.add_binding(mm.TopicBinding(), RoundRobinRingExchange(ring))
+        self.add_binding(mm.TopicBinding(), topics)
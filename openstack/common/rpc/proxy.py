@@ -21,6 +21,8 @@ For more information about rpc API version numbers, see:
     rpc/dispatcher.py
 """
 
+import eventlet
+from eventlet import queue
 
 from heat.openstack.common import rpc
 from heat.openstack.common.rpc import common as rpc_common
@@ -154,6 +156,71 @@ class RpcProxy(object):
             raise rpc.common.Timeout(
                 exc.info, real_topic, msg.get('method'))
 
+    def scatter(self, context, msg, topics, version=None, timeout=None,
+                deadline=None, enough=None):
+        """rpc.multicall() a remote method on several topics at once.
+
+        Results are yielded as (topic, result) pairs as soon as any
+        responder sends them, rather than responder by responder.
+
+        :param context: The request context
+        :param msg: The message to send, including the method and args.
+        :param topics: The topics of the responders, one multicall each.
+        :param version: (Optional) Override the requested API version in this
+               message.
+        :param timeout: (Optional) Seconds to wait for each reply of a
+               responder.
+        :param deadline: (Optional) Seconds a responder has to send all of
+               its replies. Responders over their deadline are dropped.
+        :param enough: (Optional) Stop once this many responders have sent
+               all of their replies.
+
+        :returns: An iterator of (topic, result) pairs. Responders which
+                  time out or fail are left out, unless all of them do; the
+                  first error is then raised. Calls still outstanding when
+                  the iterator stops, or is closed, are cancelled.
+        """
+        self._set_version(msg, version)
+        msg['args'] = self._serialize_msg_args(context, msg['args'])
+        results = queue.LightQueue()
+        done = object()
+
+        def _gather(topic):
+            try:
+                with eventlet.Timeout(deadline, rpc.common.Timeout):
+                    # multicall adds ids to the message, so each call
+                    # needs its own copy
+                    for result in rpc.multicall(context, topic, dict(msg),
+                                                timeout):
+                        results.put((topic, result, None))
+            except Exception as exc:
+                results.put((topic, done, exc))
+            else:
+                results.put((topic, done, None))
+
+        threads = [eventlet.spawn(_gather, topic) for topic in topics]
+        completed = 0
+        errors = []
+        try:
+            for i in xrange(len(threads)):
+                while True:
+                    topic, result, exc = results.get()
+                    if result is done:
+                        break
+                    yield (topic,
+                           self.serializer.deserialize_entity(context, result))
+                if exc is not None:
+                    errors.append(exc)
+                    continue
+                completed += 1
+                if enough and completed >= enough:
+                    return
+            if errors and not completed:
+                raise errors[0]
+        finally:
+            for thread in threads:
+                thread.kill()
+
     def cast(self, context, msg, topic=None, version=None):
         """rpc.cast() a remote method.
 
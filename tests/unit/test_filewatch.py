@@ -0,0 +1,99 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Test of file watches across fork."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from oslo.config import cfg
+
+from heat.openstack.common import filewatch
+from heat.openstack.common import policy
+from heat.openstack.common.rpc import matchmaker_ring
+
+CONF = cfg.CONF
+
+
+class ForkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ForkTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        # Make sure the mtime moves on, whatever its resolution
+        now = time.time() + 2
+        os.utime(path, (now, now))
+        return path
+
+    def _in_child(self, func):
+        """Run `func` in a forked child, failing unless it returns True."""
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ok = func()
+            except BaseException:
+                ok = False
+            os._exit(0 if ok else 1)
+        _pid, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+
+    def test_watcher_is_per_process(self):
+        parent = filewatch.get_watcher()
+
+        def child():
+            return filewatch.get_watcher() is not parent
+
+        self._in_child(child)
+
+    def test_enforcer_rewatches_after_fork(self):
+        path = self._write('policy.json', '{"admin": "role:admin"}')
+        enforcer = policy.Enforcer()
+        enforcer.policy_path = path
+        enforcer.load_rules()
+        parent_watch = enforcer._policy_watch
+
+        def child():
+            self._write('policy.json', '{"admin": "role:superuser"}')
+            enforcer.load_rules()
+            creds = {'roles': ['superuser']}
+            return (enforcer._policy_watch is not parent_watch and
+                    enforcer._policy_watch is
+                    filewatch.get_watcher().files[path] and
+                    enforcer.check_rule('admin', {}, creds))
+
+        self._in_child(child)
+
+    def test_ring_rewatches_after_fork(self):
+        path = self._write('ring.json', '{"ingest": ["a"]}')
+        CONF.set_override('ringfile', path, 'matchmaker_ring')
+        self.addCleanup(CONF.clear_override, 'ringfile', 'matchmaker_ring')
+        ring = matchmaker_ring.RingExchange()
+        parent_watch = ring._watch
+
+        def child():
+            self._write('ring.json', '{"ingest": ["b"]}')
+            ring._reload()
+            return (ring._watch is not parent_watch and
+                    ring.ring == {'ingest': ['b']})
+
+        self._in_child(child)
@@ -0,0 +1,58 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Test of keyed topics on the consistent hash ring."""
+
+import unittest
+
+from heat.openstack.common.rpc import matchmaker_ring
+
+
+class KeyedTopicTestCase(unittest.TestCase):
+
+    HOSTS = ['ingest1', 'ingest2', 'ingest3']
+
+    def setUp(self):
+        super(KeyedTopicTestCase, self).setUp()
+        self.matchmaker = matchmaker_ring.MatchMakerRing(
+            {'matra.ingest': self.HOSTS})
+
+    def test_dotted_keyed_topic_reaches_ring_host(self):
+        topic = matchmaker_ring.keyed_topic('matra.ingest', 'tenant-a')
+        queues = self.matchmaker.queues(topic)
+        self.assertEqual(1, len(queues))
+        routed_topic, host = queues[0]
+        self.assertIn(host, self.HOSTS)
+        # Where impl_zmq consumers of matra.ingest listen on that host
+        self.assertEqual('matra.' + host, routed_topic)
+
+    def test_same_key_same_host(self):
+        topic = matchmaker_ring.keyed_topic('matra.ingest', u'tenant-\xe9')
+        self.assertEqual(self.matchmaker.queues(topic),
+                         self.matchmaker.queues(topic))
+
+    def test_keys_spread_over_hosts(self):
+        hosts = set()
+        for i in xrange(100):
+            topic = matchmaker_ring.keyed_topic('matra.ingest', 'tenant%d' % i)
+            hosts.add(self.matchmaker.queues(topic)[0][1])
+        self.assertEqual(set(self.HOSTS), hosts)
+
+    def test_unknown_keyed_topic(self):
+        topic = matchmaker_ring.keyed_topic('matra.other', 'tenant-a')
+        self.assertEqual([], self.matchmaker.queues(topic))
+
+    def test_direct_topic_unchanged(self):
+        self.assertEqual([('matra.ingest1', 'ingest1')],
+                         self.matchmaker.queues('matra.ingest1'))
@@ -0,0 +1,72 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Test of compiled policy rules."""
+
+import unittest
+
+from heat.openstack.common import policy
+
+
+class CompiledRuleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(CompiledRuleTestCase, self).setUp()
+        self.enforcer = policy.Enforcer()
+        self.enforcer.set_rules(policy.Rules.load_json("""{
+            "owner": "tenant:%(tenant_id)s",
+            "admin": "role:admin",
+            "owner_or_admin": "rule:owner or rule:admin",
+            "is_admin": "is_admin:True",
+            "remote": "http://localhost/check or rule:admin"
+        }"""))
+
+    def test_missing_target_key_fails_closed(self):
+        creds = {'tenant': 'spam', 'roles': []}
+        self.assertFalse(self.enforcer.check_rule('owner', {}, creds))
+        self.assertTrue(self.enforcer.check_rule(
+            'owner', {'tenant_id': 'spam'}, creds))
+
+    def test_missing_target_key_in_nested_rule(self):
+        creds = {'tenant': 'spam', 'roles': ['admin']}
+        self.assertTrue(self.enforcer.check_rule('owner_or_admin', {}, creds))
+        creds = {'tenant': 'spam', 'roles': []}
+        self.assertFalse(self.enforcer.check_rule('owner_or_admin', {},
+                                                  creds))
+
+    def test_creds_without_roles_fail_closed(self):
+        self.assertFalse(self.enforcer.check_rule('admin', {}, {}))
+        self.assertFalse(self.enforcer._enforce_cached('admin', {}, {}))
+        self.assertTrue(self.enforcer._enforce_cached(
+            'admin', {}, {'roles': ['Admin']}))
+
+    def test_cached_decision_fails_closed(self):
+        self.assertFalse(self.enforcer._enforce_cached(
+            'owner_or_admin', {}, {'tenant': 'spam'}))
+        self.assertFalse(self.enforcer._enforce_cached(
+            'owner_or_admin', {}, {'tenant': 'spam'}))
+
+    def test_cache_tells_value_types_apart(self):
+        self.assertTrue(self.enforcer._enforce_cached(
+            'is_admin', {}, {'is_admin': True}))
+        self.assertFalse(self.enforcer._enforce_cached(
+            'is_admin', {}, {'is_admin': 1}))
+        self.assertFalse(self.enforcer._enforce_cached(
+            'is_admin', {}, {'is_admin': 1.0}))
+
+    def test_remote_checks_not_cached(self):
+        self.assertTrue(self.enforcer._is_cacheable('owner_or_admin'))
+        self.assertFalse(self.enforcer._is_cacheable('remote'))
+        self.enforcer._enforce_cached('remote', {}, {'roles': ['admin']})
+        self.assertEqual(0, len(self.enforcer._decisions))